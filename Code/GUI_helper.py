@@ -3,40 +3,589 @@ import numpy as np
 from tkinter import *
 import tkinter as tk
 from PIL import Image, ImageTk
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+import hashlib
 import os
+import queue
+import threading
+from Code.instrumentation import *
+
+# The default number of workers used for computing the motion between frames in parallel
+NUM_WORKERS = os.cpu_count() or 1
+
+# Motion estimation parameters. These are part of the motion cache key, so changing them invalidates the cached motion.
+ORB_NUM_FEATURES = 500
+RANSAC_NUM_ITER = 100
+RANSAC_INLIER_TOL = 6
+
+# The matchers of ORB descriptors: 'crosscheck' keeps the mutual nearest neighbours, 'knn' keeps the nearest neighbours
+# which pass Lowe's ratio test with MATCH_RATIO, and 'flann' is 'knn' with an approximate FLANN-LSH search instead of a
+# brute force one. 'knn' switches to FLANN-LSH by itself when an image has at least FLANN_MIN_FEATURES features. If
+# MAX_MATCHES is not None, only the MAX_MATCHES matches with the smallest distances are kept.
+MATCHERS = ('crosscheck', 'knn', 'flann')
+MATCHER = 'crosscheck'
+MATCH_RATIO = 0.8
+FLANN_MIN_FEATURES = 5000
+FLANN_LSH_PARAMS = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)
+MAX_MATCHES = None
+
+# The motion estimators of translation-only sequences: 'orb' matches ORB features with RANSAC, 'phase' correlates the
+# frames downscaled by PHASE_CORRELATION_SCALE and 'profile' correlates the mean intensity of every column of the frames
+# (which only estimates the horizontal translation). A pair of frames whose correlation peak is weaker than
+# PHASE_CORRELATION_MIN_RESPONSE is estimated with ORB features instead. Every PHASE_CORRELATION_CHECK_EVERY-th pair is
+# also estimated with ORB features as a spot check: if the estimations differ by more than
+# PHASE_CORRELATION_MAX_DEVIATION pixels, the ORB estimation is used and the neighbouring pairs are checked as well,
+# until the estimations agree again. The correlation follows the dominant motion of the whole frame, so on sequences
+# with several moving layers it differs from ORB features: on train-in-snow, by more than a pixel on 19% of the pairs
+# for 'phase' (2% with the checks, which match 45% of the pairs with ORB features) and on 55% for 'profile', which also
+# ignores the vertical motion (13% with the checks). Checking fewer pairs (or none, with 0) is faster and less accurate.
+MOTION_ESTIMATORS = ('orb', 'phase', 'profile')
+PHASE_CORRELATION_SCALE = 2
+PHASE_CORRELATION_MIN_RESPONSE = 0.3
+PHASE_CORRELATION_CHECK_EVERY = 4
+PHASE_CORRELATION_MAX_DEVIATION = 1.0
+
+# If True, the GUIs first display previews rendered from the frames downscaled by each of PREVIEW_FACTORS (in this
+# order), and replace them with the full resolution result when it is ready.
+PROGRESSIVE_PREVIEW = True
+PREVIEW_FACTORS = (4, 2)
+
+
+def parallel_map(function, items, num_workers=1, progress=None):
+    """
+    Applies the given function on all the given items using a pool of threads.
+    :param function: the function that should be applied on every item
+    :param items: the items
+    :param num_workers: the number of threads. 1 (default) applies the function serially in the calling thread.
+    :param progress: an optional function called as progress(num_done, num_items) in the calling thread after every
+            item. If it raises an exception (for example when the computation was cancelled), the items that didn't
+            start yet are dropped and the exception is propagated.
+    :return: a list with the results of the function, in the order of the items
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if num_workers is not None and num_workers <= 1:
+        for i, item in enumerate(items):
+            results[i] = function(item)
+            if progress:
+                progress(i + 1, len(items))
+        return results
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        futures = {executor.submit(function, item): i for i, item in enumerate(items)}
+        for num_done, future in enumerate(as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            if progress:
+                progress(num_done, len(items))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return results
+
+
+def parallel_imap(function, items, num_workers=1, max_pending=None):
+    """
+    Applies the given function on all the given items using a pool of threads, and yields the results in the order of
+    the items as soon as they are ready. Unlike parallel_map, only a bounded number of results is held in memory.
+    :param function: the function that should be applied on every item
+    :param items: the items
+    :param num_workers: the number of threads. 1 (default) applies the function serially in the calling thread.
+    :param max_pending: the maximal number of items that are processed or waiting to be yielded at once. Defaults to
+            twice the number of threads.
+    :return: a generator of the results of the function, in the order of the items
+    """
+    if num_workers is not None and num_workers <= 1:
+        for item in items:
+            yield function(item)
+        return
+
+    max_pending = max_pending or 2 * num_workers
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        pending = []
+        for item in items:
+            if len(pending) >= max_pending:
+                yield pending.pop(0).result()
+            pending.append(executor.submit(function, item))
+        for future in pending:
+            yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def list_images(dir):
+    """
+    Lists the images in the given directory
+    :param dir: the directory that holds the images
+    :return: a list with the paths of all the images in the directory, in alphanumeric order
+    """
+    images_path = sorted_alphanumeric(os.listdir(dir))
+    return [dir + '/' + im_path for im_path in images_path if im_path != '.DS_Store']
+
 
+# The cv2.imread flags which decode an image at a reduced resolution, according to the reduction factor
+REDUCED_READ_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                      8: cv2.IMREAD_REDUCED_COLOR_8}
 
-def load_images(dir):
+
+def read_image(im_path, reduce=1):
+    """
+    Reads the given image
+    :param im_path: the path of the image
+    :param reduce: the factor by which the resolution of the image is reduced while decoding - 1 (full resolution), 2, 4
+            or 8. Decoding a JPEG at a reduced resolution is much faster than decoding it at full resolution.
+    :return: the decoded BGR image
+    """
+    if reduce not in REDUCED_READ_FLAGS:
+        raise ValueError(f'Unsupported resolution reduction {reduce}, should be one of {list(REDUCED_READ_FLAGS)}')
+    with span('decode'):
+        return cv2.imread(im_path, REDUCED_READ_FLAGS[reduce])
+
+
+def read_images(images_path, num_workers=1, reduce=1, progress=None):
+    """
+    Reads the given images. cv2.imread releases the GIL, so the images can be decoded in parallel.
+    :param images_path: the paths of the images
+    :param num_workers: the number of threads used for decoding the images. 1 (default) decodes the images serially.
+    :param reduce: see read_image
+    :param progress: an optional function called as progress(num_decoded, num_images) after every decoded image
+    :return: a list with the decoded images, in the order of the given paths
+    """
+    return parallel_map(lambda im_path: read_image(im_path, reduce), images_path, num_workers=num_workers,
+                        progress=progress)
+
+
+def load_images(dir, num_workers=1, reduce=1, progress=None, stride=1):
     """
     Loads the images in the given directory
-    :param dir: the directory that holds the images
+    :param dir: the directory that holds the images, or a video file (see is_video)
+    :param num_workers: the number of threads used for decoding the images (see read_images)
+    :param reduce: the factor by which the resolution of the images is reduced, for previews (see read_image)
+    :param progress: an optional function called as progress(num_decoded, num_images) after every decoded image
+    :param stride: for a video, only every stride-th frame is loaded
     :return: a list with all the images in the directory
     """
-    frames = []
-    images_path = sorted_alphanumeric(os.listdir(dir))
-    for im_path in images_path:
-        if im_path == '.DS_Store':
-            continue
-        frames.append(cv2.imread(dir + '/' + im_path))
-    return frames
+    if is_video(dir):
+        frames = []
+        for frame in iterate_video(dir, stride=stride, progress=progress):
+            frames.append(frame if reduce == 1 else cv2.resize(frame, None, fx=1 / reduce, fy=1 / reduce,
+                                                               interpolation=cv2.INTER_AREA))
+        return frames
+    return read_images(list_images(dir), num_workers=num_workers, reduce=reduce, progress=progress)
+
+
+# The extensions of the video files which can be used instead of a directory of images
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+
+def is_video(path):
+    """
+    :return: True if the given path is a video file
+    """
+    return os.path.isfile(path) and path.lower().endswith(VIDEO_EXTENSIONS)
+
+
+def video_frame_count(video_path, stride=1):
+    """
+    :return: the number of frames of the given video that are read with the given stride, according to the video
+            container. Some containers only hold an estimation of the number of frames.
+    """
+    cap = cv2.VideoCapture(video_path)
+    num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return (num_frames + stride - 1) // stride
+
+
+def iterate_video(video_path, stride=1, progress=None):
+    """
+    Decodes the frames of the given video one at a time, without displaying them.
+    :param video_path: the path of the video
+    :param stride: only every stride-th frame is decoded. The frames in between are skipped without being converted.
+    :param progress: an optional function called as progress(num_decoded, num_frames) after every decoded frame, where
+            num_frames is the estimated number of frames (see video_frame_count)
+    :return: a generator of the BGR frames of the video
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError(f'Could not open the video {video_path}')
+    num_frames = (int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) + stride - 1) // stride
+    try:
+        i = 0
+        while cap.grab():
+            if i % stride == 0:
+                with span('decode_video'):
+                    ret, frame = cap.retrieve()
+                if not ret:
+                    break
+                yield frame
+                if progress:
+                    progress(i // stride + 1, max(num_frames, i // stride + 1))
+            i += 1
+    finally:
+        cap.release()
+
+
+def frame_keys(dir, stride=1, num_frames=None):
+    """
+    Computes a key for every image in the given directory, which changes whenever the image file is replaced or edited
+    :param dir: the directory that holds the images, or a video file (see is_video)
+    :param stride: for a video, the stride with which the frames are read (see iterate_video)
+    :param num_frames: for a video, the number of frames that were read. Defaults to video_frame_count.
+    :return: a list with a '<file name>:<size>:<modification time>' string for every image in the directory. For a
+            video, the file name is '<video name>@<frame number>'.
+    """
+    if is_video(dir):
+        stat = os.stat(dir)
+        num_frames = video_frame_count(dir, stride) if num_frames is None else num_frames
+        return [f'{os.path.basename(dir)}@{i * stride}:{stat.st_size}:{stat.st_mtime_ns}' for i in range(num_frames)]
+    keys = []
+    for im_path in list_images(dir):
+        stat = os.stat(im_path)
+        keys.append(f'{os.path.basename(im_path)}:{stat.st_size}:{stat.st_mtime_ns}')
+    return keys
+
+
+def motion_params_key(translation_only=False, estimator='orb'):
+    """
+    :return: a string describing all the parameters the motion between frames depends on
+    """
+    key = f'translation_only={bool(translation_only)},orb_features={ORB_NUM_FEATURES},' \
+          f'ransac_iter={RANSAC_NUM_ITER},ransac_tol={RANSAC_INLIER_TOL}'
+    if estimator != 'orb':
+        key += f',estimator={estimator},scale={PHASE_CORRELATION_SCALE},' \
+               f'min_response={PHASE_CORRELATION_MIN_RESPONSE},check_every={PHASE_CORRELATION_CHECK_EVERY},' \
+               f'max_deviation={PHASE_CORRELATION_MAX_DEVIATION}'
+    if MATCHER != 'crosscheck' or MAX_MATCHES is not None:
+        key += f',matcher={MATCHER},ratio={MATCH_RATIO},flann_min={FLANN_MIN_FEATURES},max_matches={MAX_MATCHES}'
+    return key
+
+
+def motion_cache_path(cache_dir, name, translation_only=False, estimator='orb'):
+    """
+    Returns the path of the motion cache file of a sequence. The motion estimation parameters are hashed into the file
+    name, so the motion of the same sequence computed with different parameters is kept in different files.
+    :param cache_dir: the directory of the motion files
+    :param name: the name of the sequence
+    :param translation_only: see compute_homographies
+    :param estimator: see compute_homographies
+    :return: the path of the motion file
+    """
+    params_hash = hashlib.sha1(motion_params_key(translation_only, estimator).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f'{name}-{params_hash}.npz')
+
+
+def load_motion(cache_path, translation_only=False, estimator='orb'):
+    """
+    Loads the cached motion of a sequence.
+    :param cache_path: the path of the motion file
+    :param translation_only: see compute_homographies
+    :param estimator: see compute_homographies
+    :return: a dictionary mapping a pair of frame keys (see frame_keys) to the 3x3 homography between these frames. If
+            the file does not exist or was computed with different parameters, an empty dictionary is returned.
+    """
+    try:
+        with np.load(cache_path) as data:
+            if str(data['params']) != motion_params_key(translation_only, estimator):
+                return {}
+            homographies = data['homographies']
+            if 'pair_keys' in data.files:
+                pair_keys = data['pair_keys']
+                return {(str(key1), str(key2)): homographies[:, :, i] for i, (key1, key2) in enumerate(pair_keys)}
+            keys = list(data['keys'])
+    except (IOError, KeyError, ValueError):
+        return {}
+    return {(keys[i], keys[i + 1]): homographies[:, :, i] for i in range(len(keys) - 1)}
+
+
+def save_motion(cache_path, keys, homographies, translation_only=False, estimator='orb'):
+    """
+    Saves the motion of a sequence in a binary motion file.
+    :param cache_path: the path of the motion file
+    :param keys: the keys of the frames of the sequence (see frame_keys)
+    :param homographies: the homographies between every two consecutive frames of the sequence
+    :param translation_only: see compute_homographies
+    :param estimator: see compute_homographies
+    """
+    np.savez(cache_path, homographies=homographies, keys=np.array(keys),
+             params=np.array(motion_params_key(translation_only, estimator)))
+
+
+def save_motion_pairs(cache_path, pairs, translation_only=False, estimator='orb'):
+    """
+    Saves the motion of arbitrary pairs of frames in a binary motion file, e.g. pairs of several captures of a sequence.
+    :param cache_path: the path of the motion file
+    :param pairs: a dictionary mapping a pair of frame keys to the 3x3 homography between these frames, as returned by
+            load_motion
+    :param translation_only: see compute_homographies
+    :param estimator: see compute_homographies
+    """
+    homographies = np.stack(list(pairs.values()), axis=2) if pairs else np.zeros((3, 3, 0))
+    np.savez(cache_path, homographies=homographies, pair_keys=np.array(list(pairs), dtype=str).reshape(-1, 2),
+             params=np.array(motion_params_key(translation_only, estimator)))
+
+
+def load_or_compute_motion(frames, keys, cache_dir, name, translation_only=False, num_workers=1, features=None,
+                           progress=None, estimator='orb'):
+    """
+    Returns the homographies between every two consecutive frames, using the motion file of the sequence. Only pairs of
+    frames which are not in the motion file (for example, frames that were added or changed) are computed, and the
+    motion file is updated accordingly.
+    :param frames: the frames of the sequence
+    :param keys: the keys of the frames (see frame_keys), in the same order as the frames
+    :param cache_dir: the directory of the motion files
+    :param name: the name of the sequence
+    :param translation_only: see compute_homographies
+    :param num_workers: see compute_homographies
+    :param features: see compute_homographies
+    :param progress: see compute_homographies
+    :param estimator: see compute_homographies
+    :return: an ndarray of shape 3x3x(len(frames)-1) holding all homographies between consecutive frames.
+    """
+    cache_path = motion_cache_path(cache_dir, name, translation_only, estimator)
+    cached = load_motion(cache_path, translation_only, estimator)
+    pairs = [i for i in range(len(frames) - 1) if (keys[i], keys[i + 1]) not in cached]
+    homographies = compute_homographies(frames, translation_only=translation_only, num_workers=num_workers,
+                                        features=features, pairs=pairs, progress=progress, estimator=estimator)
+    for i in range(len(frames) - 1):
+        if (keys[i], keys[i + 1]) in cached:
+            homographies[:, :, i] = cached[(keys[i], keys[i + 1])]
+    if pairs:
+        save_motion(cache_path, keys, homographies, translation_only, estimator)
+    return homographies
 
 
-def compute_homographies(frames, translation_only=False):
+def compute_homographies(frames, translation_only=False, num_workers=1, seed=None, features=None, pairs=None,
+                         progress=None, estimator='orb'):
     """
     Computes the homography between every two consecutive frames in the given list of frames
     :param frames: a list with frames for which the homographies should be calculated
     :param translation_only: indicates if the motion in the sequence is a pure translation motion
+    :param num_workers: the number of threads used for computing the homographies. OpenCV releases the GIL while
+            detecting and matching features, so the pairs can be processed in parallel. 1 (default) computes the
+            homographies serially.
+    :param seed: a seed for the RANSAC random generators. Every pair gets its own generator spawned from this seed, so
+            the result is identical for any number of workers.
+    :param features: a FeatureStore of the given frames. If None, the features of the required frames are computed here.
+    :param pairs: the indices i of the pairs (i, i+1) that should be computed. If None, all pairs are computed. The
+            homographies of the other pairs are left as zeros.
+    :param progress: an optional function called as progress(num_done, num_total) while detecting the features and
+            while matching the pairs (see parallel_map)
+    :param estimator: one of MOTION_ESTIMATORS. The correlation estimators are only used for translation-only motion,
+            and fall back to ORB features for pairs whose correlation peak is weak.
     :return: an ndarray of shape 3x3xlen(frames) holding all homographies between consecutive frames.
             homographies[:,:,i] is the 3x3 homography between the frames i and i+1
     """
     num_frames = len(frames)
-    homographies = np.zeros((3, 3, num_frames - 1))
-    for i in range(num_frames - 1):
-        homographies[:, :, i] = Homography(frames[i], frames[i + 1], translation_only=translation_only)
+    if pairs is None:
+        pairs = range(num_frames - 1)
+    required_frames = sorted(set(pairs) | set(i + 1 for i in pairs))
+    if features is None:
+        features = FeatureStore(frames, num_workers=num_workers, indices=[])
+    if estimator != 'orb':
+        if not translation_only:
+            raise ValueError(f"The '{estimator}' motion estimator only estimates translations")
+        return correlate_homographies(frames, features, pairs, required_frames, estimator, num_workers, seed, progress)
+    with span('compute_homographies', num_pairs=len(pairs)):
+        features.detect(required_frames, num_workers=num_workers, progress=progress)
+        homographies = np.zeros((3, 3, num_frames - 1))
+        rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(num_frames - 1)]
+
+        def pair_homography(i):
+            return match_features(*features[i + 1], *features[i], translation_only=translation_only, rng=rngs[i])
+
+        for i, H in zip(pairs, parallel_map(pair_homography, pairs, num_workers=num_workers, progress=progress)):
+            homographies[:, :, i] = H
     return homographies
 
 
-def Homography(img1, img2, selection_area=None, translation_only=False):
+def correlate_homographies(frames, features, pairs, required_frames, estimator, num_workers=1, seed=None,
+                           progress=None):
+    """
+    Computes the translations between the given pairs of consecutive frames by phase correlation (see
+    compute_homographies). Pairs with a weak correlation peak, or which fail the spot checks against ORB features (see
+    PHASE_CORRELATION_CHECK_EVERY), are computed from ORB features instead.
+    :return: an ndarray of shape 3x3x(len(frames)-1) holding the homographies of the given pairs
+    """
+    if estimator not in MOTION_ESTIMATORS:
+        raise ValueError(f"Unknown motion estimator '{estimator}', should be one of {list(MOTION_ESTIMATORS)}")
+    with span('compute_homographies', num_pairs=len(pairs), estimator=estimator):
+        signals = dict(zip(required_frames, parallel_map(lambda i: correlation_signal(frames[i], estimator),
+                                                         required_frames, num_workers=num_workers)))
+        window = None
+        if estimator == 'phase' and signals:
+            window = cv2.createHanningWindow(signals[required_frames[0]].shape[::-1], cv2.CV_32F)
+        homographies = np.zeros((3, 3, len(frames) - 1))
+        rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(len(frames) - 1)]
+
+        correlations = parallel_map(lambda i: phase_correlation(signals[i + 1], signals[i], window), pairs,
+                                    num_workers=num_workers, progress=progress)
+        translations = {}
+        for i, (H, response) in zip(pairs, correlations):
+            homographies[:, :, i] = H
+            if response >= PHASE_CORRELATION_MIN_RESPONSE:
+                translations[i] = H[:2, 2]
+
+        # the weak pairs and the spot checks are matched with ORB features, in waves which spread from every pair that
+        # failed its check to its neighbours
+        every = PHASE_CORRELATION_CHECK_EVERY
+        checks = [i for i in pairs if i not in translations or (every and i % every == every // 2)]
+        checked, num_inconsistent = set(), 0
+        while checks:
+            matched = parallel_map(lambda i: match_features(*features[i + 1], *features[i], translation_only=True,
+                                                            rng=rngs[i]), checks, num_workers=num_workers)
+            spread = set()
+            for i, H in zip(checks, matched):
+                checked.add(i)
+                if i not in translations:
+                    homographies[:, :, i] = H
+                elif np.abs(H[:2, 2] - translations[i]).max() > PHASE_CORRELATION_MAX_DEVIATION:
+                    homographies[:, :, i] = H
+                    num_inconsistent += 1
+                    spread.update(j for j in (i - 1, i + 1) if j in translations and j not in checked)
+            checks = sorted(spread)
+        PROFILER.count('phase_correlation', pairs=len(pairs), weak=len(pairs) - len(translations), checked=len(checked),
+                       inconsistent=num_inconsistent)
+    return homographies
+
+
+def correlation_signal(frame, estimator):
+    """
+    Prepares a frame for phase correlation.
+    :param frame: a BGR frame
+    :param estimator: 'phase' or 'profile' (see MOTION_ESTIMATORS)
+    :return: for 'phase', the float32 grayscale frame downscaled by PHASE_CORRELATION_SCALE. For 'profile', the mean
+            intensity of every column of the frame.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    if estimator == 'profile':
+        return gray.mean(axis=0)
+    scale = 1 / PHASE_CORRELATION_SCALE
+    return cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def phase_correlation(signal1, signal2, window=None):
+    """
+    Estimates the translation between two frames by phase correlation.
+    :param signal1: the prepared second frame of the pair (see correlation_signal)
+    :param signal2: the prepared first frame of the pair
+    :param window: the Hanning window of 2D signals (see cv2.createHanningWindow)
+    :return: A list containing:
+            1) the 3x3 translation homography between the frames, in the format of match_features
+            2) the response of the correlation peak, between 0 and 1. A weak peak means the estimation is unreliable.
+    """
+    with span('phase_correlation'):
+        if signal1.ndim == 2:
+            (dx, dy), response = cv2.phaseCorrelate(signal1, signal2, window)
+            dx, dy = dx * PHASE_CORRELATION_SCALE, dy * PHASE_CORRELATION_SCALE
+        else:
+            n = len(signal1)
+            window = np.hanning(n)
+            cross_power = np.fft.rfft(signal2 * window) * np.conj(np.fft.rfft(signal1 * window))
+            correlation = np.fft.irfft(cross_power / (np.abs(cross_power) + 1e-9), n)
+            peak = int(np.argmax(correlation))
+            response = correlation[peak]
+            # the peak is refined to subpixel accuracy by the centroid of its neighborhood (like cv2.phaseCorrelate)
+            neighborhood = correlation[[peak - 1, peak, (peak + 1) % n]]
+            dx = peak + (neighborhood[2] - neighborhood[0]) / max(neighborhood.sum(), 1e-9)
+            dx, dy = dx - n if dx > n / 2 else dx, 0
+    return [np.array([[1, 0, dx], [0, 1, dy], [0, 0, 1]], dtype=np.float64), response]
+
+
+def detect_features(img, mask=None):
+    """
+    Detects the ORB feature points of the given image
+    :param img: the image in which the features should be detected
+    :param mask: an optional uint8 mask of the image, specifying where to look for features
+    :return: A list containing:
+            1) An array with shape (N,2) of float32 [x,y] coordinates of the detected feature points.
+            2) An array with shape (N,32) of the uint8 ORB descriptors of the feature points.
+    """
+    orb = cv2.ORB_create(nfeatures=ORB_NUM_FEATURES)
+    with span('orb_detect'):
+        kpt, des = orb.detectAndCompute(img, mask)
+    points = np.float32([k.pt for k in kpt]).reshape(-1, 2)
+    if des is None:
+        des = np.zeros((0, 32), dtype=np.uint8)
+    return [points, des]
+
+
+def match_features(points1, des1, points2, des2, translation_only=False, rng=None):
+    """
+    Matches the given features of two images and computes the homography transforming points1 towards points2.
+    :param points1: An array with shape (N,2) of the feature points in the first image
+    :param des1: An array with shape (N,32) of the descriptors of points1
+    :param points2: An array with shape (M,2) of the feature points in the second image
+    :param des2: An array with shape (M,32) of the descriptors of points2
+    :param translation_only: see estimate rigid transform
+    :param rng: the random generator used by RANSAC (see ransac_homography)
+    :return: A 3x3 matrix, representing the homography between the two given sets of features.
+    """
+    src_pts, dst_pts = match_points(points1, des1, points2, des2)
+    with span('ransac'):
+        M, inliers = ransac_homography(src_pts, dst_pts, RANSAC_NUM_ITER, RANSAC_INLIER_TOL, translation_only, rng)
+
+    return M
+
+
+def match_points(points1, des1, points2, des2, matcher=None, ratio=None, max_matches=None):
+    """
+    Matches the given features of two images. The nearest neighbours are found as arrays (by cv2.batchDistance or a
+    FLANN index), so no Python work is done per match. The number of features, candidate matches and kept matches are
+    counted by the profiler under 'match'.
+    :param points1: An array with shape (N,2) of the feature points in the first image
+    :param des1: An array with shape (N,32) of the descriptors of points1
+    :param points2: An array with shape (M,2) of the feature points in the second image
+    :param des2: An array with shape (M,32) of the descriptors of points2
+    :param matcher: one of MATCHERS. If None, MATCHER is used.
+    :param ratio: the ratio of Lowe's ratio test. If None, MATCH_RATIO is used.
+    :param max_matches: the maximal number of matches to keep. If None, MAX_MATCHES is used.
+    :return: two arrays with shape (K,2) of the matched points in the first and in the second image, ordered by the
+            distance between their descriptors
+    """
+    matcher = MATCHER if matcher is None else matcher
+    ratio = MATCH_RATIO if ratio is None else ratio
+    max_matches = MAX_MATCHES if max_matches is None else max_matches
+    if matcher not in MATCHERS:
+        raise ValueError(f'Unknown matcher {matcher}, expected one of {MATCHERS}')
+
+    with span('match', matcher=matcher):
+        if matcher == 'crosscheck':
+            distances, indices = nearest_neighbours(des1, des2, 1, crosscheck=True)
+            query = np.flatnonzero(indices[:, 0] >= 0)
+            candidates = len(query)
+        else:
+            flann = matcher == 'flann' or min(len(des1), len(des2)) >= FLANN_MIN_FEATURES
+            distances, indices = nearest_neighbours(des1, des2, 2, flann=flann)
+            candidates = np.count_nonzero(indices[:, 0] >= 0)
+            query = np.flatnonzero((indices[:, 0] >= 0) & (indices[:, 1] >= 0) &
+                                   (distances[:, 0] < ratio * distances[:, 1]))
+        # a stable sort keeps the matches of equal distances in the order of points1
+        query = query[np.argsort(distances[query, 0], kind='stable')][:max_matches]
+        src_pts = points1[query]
+        dst_pts = points2[indices[query, 0]]
+    PROFILER.count('match', features=len(des1), candidates=int(candidates), matches=len(query))
+    return src_pts, dst_pts
+
+
+def nearest_neighbours(des1, des2, k, crosscheck=False, flann=False):
+    """
+    Finds the k nearest neighbours in des2 of every descriptor in des1 by their hamming distance.
+    :param crosscheck: if True (and k is 1), only mutual nearest neighbours are kept
+    :param flann: if True, an approximate FLANN-LSH search is used instead of a brute force search
+    :return: two arrays with shape (N,k) of the distances and of the indices in des2 of the nearest neighbours of every
+            descriptor in des1. Missing neighbours have the index -1.
+    """
+    if len(des1) == 0 or len(des2) < k:
+        return np.zeros((len(des1), k), dtype=np.int32), np.full((len(des1), k), -1, dtype=np.int32)
+    if flann:
+        index = cv2.flann_Index(des2, FLANN_LSH_PARAMS)
+        indices, distances = index.knnSearch(des1, k, params={})
+        return distances, indices
+    return cv2.batchDistance(des1, des2, cv2.CV_32S, normType=cv2.NORM_HAMMING, K=k, crosscheck=crosscheck)
+
+
+def Homography(img1, img2, selection_area=None, translation_only=False, rng=None):
     """
     Computes the homography between the two given images.
     :param img1: The first image
@@ -45,69 +594,203 @@ def Homography(img1, img2, selection_area=None, translation_only=False):
             homography between two images according to a selected object in the image and not the global motion.
     :param translation_only: A flag indicating if the input sequence is a pure translation sequence. If True, the
             2x2 rotation part of the homography will be the identity matrix
+    :param rng: the random generator used by RANSAC (see ransac_homography)
     :return: A 3x3 matrix, representing the homography between the two given frames.
     """
     if img2 is None:
         return
-    orb = cv2.ORB_create()
 
     # use mask:
+    prev_mask = None
     if selection_area:
         prev_mask = np.zeros_like(img2[:, :, 0])
         prev_mask[selection_area[0]:selection_area[1], selection_area[2]:selection_area[3]] = 255
-        kpt1, des1 = orb.detectAndCompute(img2, prev_mask)
-        kpt2, des2 = orb.detectAndCompute(img1, prev_mask)
 
-    else:
-        kpt1, des1 = orb.detectAndCompute(img2, None)
-        kpt2, des2 = orb.detectAndCompute(img1, None)
+    return match_features(*detect_features(img2, prev_mask), *detect_features(img1, prev_mask),
+                          translation_only=translation_only, rng=rng)
 
-    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-    matches = bf.match(des1, des2)
-    matches = sorted(matches, key=lambda x: x.distance)
 
-    src_pts = np.float32([kpt1[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([kpt2[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
+class FeatureStore:
+    """
+    Holds the ORB feature points and descriptors of every frame in a sequence, so the features of every frame are
+    detected only once and can be reused by all the homographies the frame takes part in.
+    """
 
-    M, inliers = ransac_homography(src_pts[:, 0, :], dst_pts[:, 0, :], 100, 6, translation_only)
+    # If less features than this are left in a selected area, the area is detected again using a mask
+    MIN_AREA_FEATURES = 10
 
-    return M
+    def __init__(self, frames, num_workers=1, indices=None):
+        """
+        Detects the features of the given frames.
+        :param frames: the frames of the sequence
+        :param num_workers: the number of threads used for detecting the features
+        :param indices: the indices of the frames to detect right away. If None, all the frames are detected. The
+                features of the other frames are detected when they are first accessed.
+        """
+        self.frames = frames
+        self.points = [None] * len(frames)
+        self.descriptors = [None] * len(frames)
+        self.detect(range(len(frames)) if indices is None else indices, num_workers=num_workers)
 
+    def detect(self, indices, num_workers=1, progress=None):
+        """
+        Detects the features of the given frames, skipping frames whose features were already detected.
+        :param indices: the indices of the frames to detect
+        :param num_workers: the number of threads used for detecting the features
+        :param progress: see parallel_map
+        """
+        indices = [i for i in indices if self.points[i] is None]
+        features = parallel_map(lambda i: detect_features(self.frames[i]), indices, num_workers=num_workers,
+                                progress=progress)
+        for i, (points, des) in zip(indices, features):
+            self.points[i] = points
+            self.descriptors[i] = des
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self, i):
+        """
+        :return: A list with the feature points and the descriptors of frame i
+        """
+        if self.points[i] is None:
+            self.detect([i])
+        return [self.points[i], self.descriptors[i]]
 
-def ransac_homography(points1, points2, num_iter, inlier_tol, translation_only=False):
+    def select(self, i, selection_area):
+        """
+        Returns the features of frame i which are located in the given selection area. If the area holds too few of the
+        already computed features, the features are detected again inside the area only.
+        :param i: the index of the frame
+        :param selection_area: [min_row, max_row, min_col, max_col] of the selected area
+        :return: A list with the feature points and the descriptors of frame i in the selected area
+        """
+        points, des = self[i]
+        in_area = (points[:, 1] >= selection_area[0]) & (points[:, 1] < selection_area[1]) & \
+                  (points[:, 0] >= selection_area[2]) & (points[:, 0] < selection_area[3])
+        if np.count_nonzero(in_area) >= self.MIN_AREA_FEATURES:
+            return [points[in_area], des[in_area]]
+        mask = np.zeros_like(self.frames[i][:, :, 0])
+        mask[selection_area[0]:selection_area[1], selection_area[2]:selection_area[3]] = 255
+        return detect_features(self.frames[i], mask)
+
+
+def ransac_homography(points1, points2, num_iter, inlier_tol, translation_only=False, rng=None, confidence=0.99,
+                      batch_size=25):
     """
-    Computes homography between two sets of points using RANSAC.
+    Computes homography between two sets of points using RANSAC. The hypotheses are drawn, fitted and scored in
+    vectorized batches, and the number of iterations is adapted to the inlier ratio found so far.
     :param points1: An array with shape (N,2) containing N rows of [x,y] coordinates of matched points in image 1.
     :param points2: An array with shape (N,2) containing N rows of [x,y] coordinates of matched points in image 2.
-    :param num_iter: Number of RANSAC iterations to perform.
+    :param num_iter: Maximal number of RANSAC iterations to perform.
     :param inlier_tol: inlier tolerance threshold.
     :param translation_only: see estimate rigid transform
+    :param rng: a numpy random Generator or a seed used for sampling the points. If None, a fresh generator is used.
+    :param confidence: the probability of drawing at least one all-inlier sample, used for stopping early. If None, all
+            num_iter iterations are performed.
+    :param batch_size: the number of hypotheses drawn and scored together.
     :return: A list containing:
             1) A 3x3 normalized homography matrix.
             2) An Array with shape (S,) where S is the number of inliers,
             containing the indices in pos1/pos2 of the maximal set of inlier matches found.
     """
+    rng = np.random.default_rng(rng)
+    points1 = np.asarray(points1, dtype=np.float64)
+    points2 = np.asarray(points2, dtype=np.float64)
     N = points1.shape[0]
-    largest_inlier_set = []
-    for iter in range(num_iter):
-        if translation_only:  # if True only 1 point should be sampled
-            J = np.random.choice(np.arange(N), 1)
-        else:  # transformation is rigid, so 2 distinct points are required
-            J = np.random.choice(np.arange(N), 2, replace=False)
-        p1_J = points1[J]
-        p2_J = points2[J]
-        H12 = estimate_rigid_transform(p1_J, p2_J, translation_only)
-        transformed_points2 = apply_homography(points1, H12)
-        E = np.power(np.linalg.norm(transformed_points2 - points2, axis=1), 2)
-        current_inlier_set = np.where(E < inlier_tol)[0]
-        if len(current_inlier_set) > len(largest_inlier_set):
-            largest_inlier_set = current_inlier_set
+    sample_size = 1 if translation_only else 2
+    required_iter = num_iter
+    best_count = 0
+    largest_inlier_set = np.zeros(0, dtype=int)
+    done = 0
+    while done < required_iter:
+        B = min(batch_size, num_iter - done)
+        J = sample_indices(N, B, sample_size, rng)
+        rotations, translations = estimate_rigid_transform_batch(points1[J], points2[J], translation_only)
+
+        # score all hypotheses of the batch at once
+        transformed_points1 = points1 @ rotations.transpose(0, 2, 1) + translations[:, None, :]
+        E = np.sum((transformed_points1 - points2) ** 2, axis=2)
+        inliers = E < inlier_tol
+        counts = np.count_nonzero(inliers, axis=1)
+        best = np.argmax(counts)
+        if counts[best] > best_count:
+            best_count = counts[best]
+            largest_inlier_set = np.flatnonzero(inliers[best])
+            if confidence is not None:
+                required_iter = min(num_iter, adaptive_num_iter(best_count / N, sample_size, confidence))
+        done += B
+
     p1_inliers = points1[largest_inlier_set]
     p2_inliers = points2[largest_inlier_set]
     final_H12 = estimate_rigid_transform(p1_inliers, p2_inliers, translation_only)
+    PROFILER.count('ransac', iterations=done, points=N, inliers=int(best_count))
     return [final_H12, largest_inlier_set]
 
 
+def sample_indices(N, num_samples, sample_size, rng):
+    """
+    Draws random RANSAC samples of distinct point indices.
+    :param N: the number of points
+    :param num_samples: the number of samples to draw
+    :param sample_size: the number of points in every sample (1 or 2)
+    :param rng: a numpy random Generator
+    :return: An integer array with shape (num_samples, sample_size) of point indices.
+    """
+    first = rng.integers(0, N, size=num_samples)
+    if sample_size == 1:
+        return first[:, None]
+    # draw the second index from the remaining N-1 points, so the two indices are always distinct
+    second = rng.integers(0, N - 1, size=num_samples)
+    second += second >= first
+    return np.stack((first, second), axis=1)
+
+
+def adaptive_num_iter(inlier_ratio, sample_size, confidence):
+    """
+    Computes the number of RANSAC iterations required for drawing at least one all-inlier sample.
+    :param inlier_ratio: the fraction of inliers among the points
+    :param sample_size: the number of points in every sample
+    :param confidence: the required probability of drawing an all-inlier sample
+    :return: the required number of iterations
+    """
+    good_sample_prob = inlier_ratio ** sample_size
+    if good_sample_prob >= 1:
+        return 1
+    if good_sample_prob <= 0:
+        return np.inf
+    return int(np.ceil(np.log(1 - confidence) / np.log(1 - good_sample_prob)))
+
+
+def estimate_rigid_transform_batch(points1, points2, translation_only=False):
+    """
+    Computes the rigid transforms of many small sets of corresponding points at once, using the closed form least
+    squares solution of the 2D rotation angle.
+    :param points1: array with shape (B,S,2). Holds B sets of S points from image 1.
+    :param points2: array with shape (B,S,2). Holds the corresponding points from image 2.
+    :param translation_only: whether to compute translation only. False (default) to compute rotation as well.
+    :return: A list containing:
+            1) An array with shape (B,2,2) of the rotation matrices.
+            2) An array with shape (B,2) of the translations.
+    """
+    centroid1 = points1.mean(axis=1)
+    centroid2 = points2.mean(axis=1)
+    B = points1.shape[0]
+    if translation_only:
+        rotations = np.broadcast_to(np.eye(2), (B, 2, 2))
+        return [rotations, centroid2 - centroid1]
+    centered_points1 = points1 - centroid1[:, None, :]
+    centered_points2 = points2 - centroid2[:, None, :]
+    dot = np.sum(centered_points1 * centered_points2, axis=2).sum(axis=1)
+    cross = np.sum(centered_points1[:, :, 0] * centered_points2[:, :, 1] -
+                   centered_points1[:, :, 1] * centered_points2[:, :, 0], axis=1)
+    theta = np.arctan2(cross, dot)
+    cos, sin = np.cos(theta), np.sin(theta)
+    rotations = np.stack((np.stack((cos, -sin), axis=1), np.stack((sin, cos), axis=1)), axis=1)
+    translations = centroid2 - np.einsum('bij,bj->bi', rotations, centroid1)
+    return [rotations, translations]
+
+
 def apply_homography(pos1, H12):
     """
     Apply homography to inhomogenous points.
@@ -173,6 +856,91 @@ def accumulate_homographies(H_succesive, m):
     return H2m
 
 
+class MotionTrajectory:
+    """
+    The motion of a whole sequence, computed once from the homographies between every two consecutive frames. The
+    homographies from every frame to the first frame and their inverses are precomputed, so the homography from any
+    frame to any reference frame is a single product, and the rounded x-translations are kept as prefix sums, so the
+    motion between any two frames is found in constant time.
+    """
+
+    def __init__(self, homographies):
+        """
+        :param homographies: a 3x3x(N-1) array of the homographies between every two consecutive frames, as returned by
+                compute_homographies
+        """
+        if homographies is None:
+            raise Exception("Please press 'Compute Motion' first!")
+        self.homographies = homographies
+        num_frames = homographies.shape[2] + 1
+        inverses = np.linalg.inv(homographies.transpose(2, 0, 1))
+        self.to_first = np.empty((num_frames, 3, 3))
+        self.from_first = np.empty((num_frames, 3, 3))
+        self.to_first[0] = self.from_first[0] = np.eye(3)
+        for i in range(1, num_frames):
+            self.to_first[i] = self.to_first[i - 1] @ inverses[i - 1]
+            self.to_first[i] /= self.to_first[i, 2, 2]
+            self.from_first[i] = homographies[:, :, i - 1] @ self.from_first[i - 1]
+            self.from_first[i] /= self.from_first[i, 2, 2]
+        self.motions = np.round(homographies[0, 2, :]).astype(int)
+        self.motion_offsets = np.concatenate([[0], np.cumsum(self.motions)])
+        self.reference = None
+        self.accumulated = None
+
+    def __len__(self):
+        return len(self.to_first)
+
+    def homography(self, frame, ref_frame):
+        """
+        :return: the 3x3 homography from the given frame to the reference frame
+        """
+        H = self.from_first[ref_frame] @ self.to_first[frame]
+        return H / H[2, 2]
+
+    def to_reference(self, ref_frame):
+        """
+        :param ref_frame: the reference frame
+        :return: an array of shape 3x3xN of the homographies from every frame to the reference frame, as returned by
+                accumulate_homographies. The homographies of the last reference frame are cached.
+        """
+        if self.reference != ref_frame:
+            accumulated = np.einsum('ij,njk->ikn', self.from_first[ref_frame], self.to_first)
+            self.accumulated = accumulated / accumulated[2, 2, :]
+            self.reference = ref_frame
+        return self.accumulated
+
+    def from_reference(self, ref_frame):
+        """
+        :param ref_frame: the reference frame
+        :return: an array of shape 3x3xN of the homographies from the reference frame to every frame, the inverses of
+                the homographies returned by to_reference
+        """
+        inverses = np.einsum('nij,jk->ikn', self.from_first, self.to_first[ref_frame])
+        return inverses / inverses[2, 2, :]
+
+    def x_motion(self, start_frame, end_frame):
+        """
+        :return: the sum of the rounded x-translations between every two consecutive frames from start_frame to
+                end_frame
+        """
+        return int(self.motion_offsets[end_frame] - self.motion_offsets[start_frame])
+
+
+def scale_homographies(homographies, scale_x, scale_y=None):
+    """
+    Rescales homographies computed on the full resolution frames to frames resized by the given factors, so the motion
+    doesn't have to be computed again for every resolution.
+    :param homographies: a 3x3xN array of homographies
+    :param scale_x: the factor by which the frames were resized in the x direction
+    :param scale_y: the factor by which the frames were resized in the y direction. Defaults to scale_x.
+    :return: a 3x3xN array of the homographies between the resized frames, S*H*S^-1 where S = diag(scale_x, scale_y, 1)
+    """
+    scale_y = scale_x if scale_y is None else scale_y
+    S = np.diag([scale_x, scale_y, 1.0])
+    S_inv = np.diag([1 / scale_x, 1 / scale_y, 1.0])
+    return np.einsum('ij,jkn,kl->iln', S, homographies, S_inv)
+
+
 def BGR2RGB(image):
     """
     convert the given image in BGR color space to RGB color space
@@ -409,6 +1177,201 @@ class UserError(Error):
         self.orig_err_msg = orig_err_msg
 
 
+class JobCancelled(Error):
+    """Exception raised inside a background job when the job was cancelled."""
+    pass
+
+
+class Job:
+    """
+    A computation submitted to a JobRunner.
+    """
+
+    def __init__(self, name, work, on_done=None, on_error=None, on_preview=None):
+        """
+        :param name: the name of the job. Jobs with the same name are coalesced.
+        :param work: the function computing the job, called as work(job) in a background thread. It must not use
+                tkinter, and should call job.report from time to time to report progress and to allow cancellation.
+        :param on_done: a function called as on_done(result) in the tkinter main loop when the job is done
+        :param on_error: a function called as on_error(exception) in the tkinter main loop if the job failed. Errors of
+                cancelled jobs are dropped.
+        :param on_preview: a function called as on_preview(preview) in the tkinter main loop for every intermediate
+                result the job publishes with job.preview
+        """
+        self.name = name
+        self.work = work
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_preview = on_preview
+        self.progress = None
+        self.previews = queue.Queue()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def report(self, num_done, num_total):
+        """
+        Reports the progress of the job. Raises JobCancelled if the job was cancelled.
+        """
+        if self.cancelled.is_set():
+            raise JobCancelled('The operation was cancelled')
+        self.progress = (num_done, num_total)
+
+    def preview(self, preview):
+        """
+        Publishes an intermediate result of the job, which is delivered to on_preview. Raises JobCancelled if the job
+        was cancelled.
+        """
+        if self.cancelled.is_set():
+            raise JobCancelled('The operation was cancelled')
+        self.previews.put(preview)
+
+
+class JobRunner:
+    """
+    Runs heavy computations in a background thread, so the GUI stays responsive, and delivers their results to the
+    tkinter main loop by polling with after(). Jobs run one at a time in the order they were submitted. Submitting a job
+    while a job with the same name is waiting replaces the waiting job, so rapid repeated requests are coalesced into a
+    single computation with the latest parameters.
+    """
+
+    POLL_MS = 50
+
+    def __init__(self, widget, progress_label=None):
+        """
+        :param widget: the tkinter widget used for scheduling the polling
+        :param progress_label: an optional label in which the progress of the running job is displayed
+        """
+        self.widget = widget
+        self.progress_label = progress_label
+        self.running = None
+        self.pending = OrderedDict()
+        self.results = queue.Queue()
+
+    def submit(self, name, work, on_done=None, on_error=None, on_preview=None):
+        """
+        Submits a new job (see Job).
+        """
+        self.pending.pop(name, None)
+        self.pending[name] = Job(name, work, on_done, on_error, on_preview)
+        if self.running is None:
+            self.start_next()
+
+    def cancel(self, name=None):
+        """
+        Cancels the running and waiting jobs with the given name, or all the jobs if no name is given.
+        """
+        for pending_name in list(self.pending):
+            if name is None or pending_name == name:
+                del self.pending[pending_name]
+        if self.running is not None and (name is None or self.running.name == name):
+            self.running.cancel()
+
+    def start_next(self):
+        self.running = None
+        if not self.pending:
+            self.show_progress('')
+            return
+        _, self.running = self.pending.popitem(last=False)
+        self.show_progress(f'{self.running.name}...')
+        threading.Thread(target=self.run, args=(self.running,), daemon=True).start()
+        self.widget.after(self.POLL_MS, self.poll)
+
+    def run(self, job):
+        try:
+            with span(f'job: {job.name}'):
+                result = job.work(job)
+            self.results.put((job, result, None))
+        except Exception as e:
+            self.results.put((job, None, e))
+
+    def poll(self):
+        while not self.running.previews.empty():
+            preview = self.running.previews.get_nowait()
+            if self.running.on_preview and not self.running.cancelled.is_set():
+                self.running.on_preview(preview)
+        try:
+            job, result, error = self.results.get_nowait()
+        except queue.Empty:
+            if self.running.progress:
+                num_done, num_total = self.running.progress
+                self.show_progress(f'{self.running.name}... {num_done}/{num_total}')
+            self.widget.after(self.POLL_MS, self.poll)
+            return
+        try:
+            if error is None:
+                if job.on_done and not job.cancelled.is_set():
+                    job.on_done(result)
+            elif job.on_error and not isinstance(error, JobCancelled) and not job.cancelled.is_set():
+                job.on_error(error)
+        finally:
+            self.start_next()
+
+    def show_progress(self, text):
+        if self.progress_label is not None:
+            self.progress_label.configure(text=text)
+
+
+def display_image(root, im, title, window=None):
+    """
+    Displays the given image to the user in a new window, or in the given window if it is still open.
+    :param root: The root tkinter object upon which a new window should be displayed
+    :param im: the BGR image that should be displayed
+    :param title: the title of the window
+    :param window: a window previously returned by this function, in which the image should be displayed
+    :return: the window displaying the image
+    """
+    if window is None or not window.winfo_exists():
+        window = Toplevel(root)
+        window.canvas = tk.Canvas(window, borderwidth=0, highlightthickness=0)
+        window.canvas.pack(expand=True)
+    window.title(title)
+    with span('imagetk'):
+        img = ImageTk.PhotoImage(Image.fromarray(BGR2RGB(im)))
+    window.canvas.configure(width=img.width(), height=img.height())
+    window.canvas.delete('all')
+    window.canvas.create_image(0, 0, image=img, anchor=tk.NW)
+    window.canvas.img = img
+    return window
+
+
+# The interval in milliseconds in which the stats panel is refreshed
+STATS_REFRESH_MS = 1000
+
+
+def display_stats(root, results_dir=os.path.join('..', 'Results')):
+    """
+    Displays a panel with the statistics of the spans recorded by PROFILER (see instrumentation.py), which is refreshed
+    while it is open. The panel can reset the statistics and export them as JSON and as a Chrome trace.
+    :param root: The root tkinter object upon which the panel should be displayed
+    :param results_dir: the directory in which the exported files are saved
+    :return: the window of the panel
+    """
+    window = Toplevel(root)
+    window.title('Stats')
+    text = tk.Text(window, width=100, height=20, font='TkFixedFont')
+    text.pack(expand=True, fill=tk.BOTH)
+
+    def refresh():
+        if not window.winfo_exists():
+            return
+        text.delete('1.0', tk.END)
+        text.insert(tk.END, PROFILER.format_summary())
+        window.after(STATS_REFRESH_MS, refresh)
+
+    def export():
+        os.makedirs(results_dir, exist_ok=True)
+        PROFILER.save_json(os.path.join(results_dir, 'stats.json'))
+        PROFILER.save_chrome_trace(os.path.join(results_dir, 'trace.json'))
+
+    tk.Button(window, text='Reset', command=PROFILER.reset).pack(side=tk.LEFT)
+    tk.Button(window, text=f"Export to {os.path.join(results_dir, 'stats.json')} and trace.json",
+              command=export).pack(side=tk.LEFT)
+    refresh()
+    return window
+
+
 def display_error(root, err_msg, original_err_msg=None):
     """
     Creates a new window with an error message for the user.
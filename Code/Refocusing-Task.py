@@ -1,6 +1,7 @@
-import copy
 from tkinter import filedialog
 from Code.GUI_helper import *
+from Code.frame_sources import *
+from Code.refocus_engine import *
 
 
 class GUI(tk.Frame):
@@ -16,14 +17,17 @@ class GUI(tk.Frame):
         self.im_shape = None
         self.ref_frame = 0
         self.frames = []
+        self.pyramid = None
         self.homographies = None
-        self.warped_im = None
-        self.refocused_im = None
+        self.trajectory = None
+        self.features = None
+        self.aligned = None
         self.dx = 0
         self.dy = 0
         self.selection_area = [0, 0, 0, 0]
         self.current_im_label = None
         self.load_label = None
+        self.result_window = None
         self.select_folder_button()
         self.motion_button()
         self.translation_only_checkbutton()
@@ -31,6 +35,11 @@ class GUI(tk.Frame):
         self.select_area_button()
         self.median_mean_radiobutton()
         self.show_button()
+        self.progress_label = self.add_label(text='', place=[310, 323])
+        self.jobs = JobRunner(self, self.progress_label)
+        self.cancel_button()
+        if PROFILING:
+            self.add_button(text='Stats', place=[15, 320], command=lambda: display_stats(root))
 
     def reset_fields(self):
         """
@@ -42,9 +51,11 @@ class GUI(tk.Frame):
         self.ref_frame = 0
         self.im_shape = None
         self.frames = []
+        self.pyramid = None
         self.homographies = None
-        self.warped_im = None
-        self.refocused_im = None
+        self.trajectory = None
+        self.features = None
+        self.aligned = None
         self.selection_area = [0, 0, 0, 0]
         self.dx = 0
         self.dy = 0
@@ -58,8 +69,9 @@ class GUI(tk.Frame):
         """
         Displays to the user the 'Select Folder' button which allows the user to select a sequence from the data
         """
-        self.add_label(text='Select images folder:', place=[15, 10])
+        self.add_label(text='Select images folder or video:', place=[15, 10])
         self.add_button(text="Select Folder", fg="black", command=self.load_dir, place=[15, 30])
+        self.add_button(text="Select Video", fg="black", command=lambda: self.load_dir(video=True), place=[110, 30])
 
     def motion_button(self):
         """
@@ -114,6 +126,10 @@ class GUI(tk.Frame):
         if parameter == 'y':
             self.dy += amount
 
+        # If a refocused image is displayed, update it. Repeated clicks are coalesced into a single render.
+        if self.result_window is not None and self.result_window.winfo_exists() and self.homographies is not None:
+            self.render_refocused_im(new_window=False)
+
     def median_mean_radiobutton(self):
         """
         Allows the user to select if a mean or a median of all the frames should be computed as the refocused image.
@@ -133,6 +149,12 @@ class GUI(tk.Frame):
         """
         self.add_button(text='Show', place=[200, 320], command=self.display_result)
 
+    def cancel_button(self):
+        """
+        Displays the 'Cancel' button, which cancels the computations that are running in the background.
+        """
+        self.add_button(text='Cancel', place=[245, 320], command=self.jobs.cancel)
+
     def display_result(self):
         """
         Calculates the refocused image according to the changes made by the user and displays the result to the user in
@@ -144,50 +166,160 @@ class GUI(tk.Frame):
             if self.homographies is None:
                 raise UserError('Please compute the motion between frames first!')
 
-            try:
-                self.current_im_label.destroy()
-            except AttributeError:
-                pass
-
-            # Check that the images are aligned. If not, align the images
-            if self.warped_im is None:
-                self.align_images()
-
             # Update the translation according to the values the user filled
             self.update_focus_parameters()
-            self.refocus_im()
-
-            # Use either mean or median for the refocused image, according to the user's selection
-            if self.med_mean_var.get() == 1:
-                refocused_im = np.median(self.refocused_im, axis=3).astype(np.uint8)
-            else:
-                refocused_im = np.mean(self.refocused_im, axis=3).astype(np.uint8)
-
-            # display the image to the user in a new window
-            window = Toplevel(root)
-            window.title('Refocused Image')
-            img = ImageTk.PhotoImage(Image.fromarray(BGR2RGB(refocused_im)))
-            canvas = tk.Canvas(window, width=img.width(), height=img.height(),
-                               borderwidth=0, highlightthickness=0)
-            canvas.pack(expand=True)
-            canvas.create_image(0, 0, image=img, anchor=tk.NW)
-            canvas.img = img
-            label_text = f'Current refocused image:\ndx={self.dx}\ndy={self.dy}'
-            self.current_im_label = self.add_label(text=label_text, place=[320, 220], borderwidth=2)
+            self.render_refocused_im()
 
         except Exception as e:
             display_error(root, 'Error occurred while refocusing the image. Error: ' + e.args[0])
 
-    def refocus_im(self):
+    def render_refocused_im(self, new_window=True):
+        """
+        Computes the refocused image with the current parameters in the background, and displays it when it is ready.
+        If PROGRESSIVE_PREVIEW is set, previews rendered from the downscaled frames are displayed first. The background
+        job only uses the state of the sequence passed to it, and the GUI keeps the motion trajectory and the aligned
+        frames it computed when it is done.
+        :param new_window: if True the image is displayed in a new window, otherwise the last window is updated
+        """
+        dx, dy, method, directory = self.dx, self.dy, self.combine_method(), self.directory
+        frames, pyramid, im_shape, ref_frame = self.frames, self.pyramid, self.im_shape, self.ref_frame
+        homographies, trajectory, aligned = self.homographies, self.trajectory, self.aligned
+
+        def work(job):
+            # the trajectory of the motion is computed once for every new motion (see MotionTrajectory)
+            cur_trajectory = trajectory
+            if cur_trajectory is None or cur_trajectory.homographies is not homographies:
+                cur_trajectory = MotionTrajectory(homographies)
+            if PROGRESSIVE_PREVIEW:
+                accum_homographies = cur_trajectory.to_reference(ref_frame)
+                for factor in PREVIEW_FACTORS:
+                    job.preview((factor, self.compute_preview(pyramid, im_shape, accum_homographies, factor, dx, dy,
+                                                              method)))
+            refocused_im, cur_aligned = self.compute_refocused_im(frames, im_shape, cur_trajectory, ref_frame, aligned,
+                                                                  dx, dy, method, job.report)
+            return cur_trajectory, cur_aligned, refocused_im
+
+        def show(refocused_im, label_text=None, title='Refocused Image'):
+            nonlocal new_window
+            if self.directory == directory:
+                self.show_refocused_im(refocused_im, label_text, new_window, title)
+                new_window = False
+
+        def done(result):
+            if self.directory == directory and self.homographies is homographies:
+                self.trajectory, self.aligned = result[:2]
+            show(result[2], f'Current refocused image:\ndx={dx}\ndy={dy}')
+
+        self.jobs.submit('Refocusing', work, done,
+                         lambda e: display_error(root, 'Error occurred while refocusing the image. Error: ' + str(e)),
+                         lambda preview: show(preview[1], title=f'Refocused Image (preview 1/{preview[0]})'))
+
+    @traced('preview')
+    def compute_preview(self, pyramid, im_shape, homographies, factor, dx=0, dy=0, method='mean'):
+        """
+        Computes a preview of the refocused image from the frames downscaled by the given factor. The motion computed on
+        the full resolution frames is rescaled to the downscaled frames.
+        :param pyramid: the FramePyramid of the sequence
+        :param im_shape: the shape of a full resolution frame
+        :param homographies: a 3x3xN array. homographies[:,:,i] is the homography from frame i to the reference frame.
+        :param factor: the factor by which the frames are downscaled
+        :param dx: the shift between consecutive frames in the x direction, in full resolution pixels
+        :param dy: the shift between consecutive frames in the y direction, in full resolution pixels
+        :param method: 'mean' or 'median'
+        :return: the preview, resized to the size of the full resolution refocused image
+        """
+        frames = pyramid.level(factor, num_workers=NUM_WORKERS)
+        scale_x, scale_y = frames.shape[2] / im_shape[1], frames.shape[1] / im_shape[0]
+        preview = refocus(frames, scale_homographies(homographies, scale_x, scale_y), frames.shape[1:],
+                          dx=dx * scale_x, dy=dy * scale_y, method=method, num_workers=NUM_WORKERS)
+        return cv2.resize(preview, (im_shape[1], im_shape[0]), interpolation=cv2.INTER_LINEAR)
+
+    def compute_refocused_im(self, frames, im_shape, trajectory, ref_frame, aligned, dx, dy, method, progress=None):
+        """
+        Computes the refocused image. This function runs in the background, so it must not use tkinter or the fields of
+        the GUI, which are reset when a new sequence is loaded.
+        :param frames: the frames of the sequence
+        :param im_shape: the shape of a frame
+        :param trajectory: the MotionTrajectory of the sequence
+        :param ref_frame: the index of the reference frame
+        :param aligned: the frames aligned to the reference frame (see align_images), or None if they are not aligned
+                yet
+        :param dx: the shift between consecutive frames in the x direction
+        :param dy: the shift between consecutive frames in the y direction
+        :param method: 'mean' or 'median'
+        :param progress: see JobRunner
+        :return: the refocused image, and the aligned frames (None if the sequence is too long to be aligned in memory)
+        """
+        if len(frames) * np.prod(im_shape) > ALIGNED_STACK_BYTES:
+            # The aligned sequence is too large to be kept in memory, align and shift one frame at a time
+            return refocus(frames, trajectory.to_reference(ref_frame), im_shape, dx=dx, dy=dy, method=method,
+                           progress=progress, num_workers=NUM_WORKERS), None
+
+        # Check that the images are aligned. If not, align the images
+        if aligned is None:
+            aligned = self.align_images(frames, im_shape, trajectory, ref_frame, progress)
+
+        shifted_frames, aligned = self.refocus_im(frames, aligned, dx, dy, progress)
+
+        # Use either mean or median for the refocused image, according to the user's selection
+        return self.combine_frames(shifted_frames, method), aligned
+
+    def show_refocused_im(self, refocused_im, label_text=None, new_window=True, title='Refocused Image'):
+        """
+        Displays the given refocused image to the user.
+        :param refocused_im: the refocused image
+        :param label_text: a text describing the image, displayed in the main window
+        :param new_window: if True the image is displayed in a new window, otherwise the last window is updated
+        :param title: the title of the window
+        """
+        try:
+            self.current_im_label.destroy()
+        except AttributeError:
+            pass
+        self.result_window = display_image(root, refocused_im, title, None if new_window else self.result_window)
+        if label_text:
+            self.current_im_label = self.add_label(text=label_text, place=[320, 220], borderwidth=2)
+
+    @traced('refocus_im')
+    def refocus_im(self, frames, aligned, dx, dy, progress=None):
         """
-        Computes the refocused image according to the translation the user defined in both axes.
+        Shifts the aligned frames according to the translation the user defined in both axes. Every frame is aligned
+        and shifted by a single warp, with subpixel interpolation.
+        :param frames: the frames of the sequence
+        :param aligned: the aligned frames (see align_images)
+        :param dx: the shift between consecutive frames in the x direction
+        :param dy: the shift between consecutive frames in the y direction
+        :param progress: see JobRunner
+        :return: a uint8 array with shape (N, H, W, 3) of the shifted frames, and the aligned frames, which keep the
+                array of the shifted frames for reusing it in the next shift
         """
-        if self.dx == 0 and self.dy == 0:
-            self.refocused_im = copy.deepcopy(self.warped_im)
-        else:
-            for i in range(self.num_frames):
-                self.refocused_im[:, :, :, i] = create_translated_im(self.warped_im[:, :, :, i], dx=self.dx * (i + 1),
-                                                                     dy=self.dy * (i + 1))
+        h_invs, warped_im, shifted_im = aligned
+        if dx == 0 and dy == 0:
+            return warped_im, aligned
+        if shifted_im is None:
+            shifted_im = np.empty_like(warped_im)
+        h_shifted = [shift_homography(h_invs[i], dx=dx * (i + 1), dy=dy * (i + 1)) for i in range(len(frames))]
+        warp_frames(frames, h_shifted, warped_im.shape[1:], out=shifted_im, num_workers=NUM_WORKERS,
+                    progress=progress)
+        return shifted_im, (h_invs, warped_im, shifted_im)
+
+    @traced('combine_frames')
+    def combine_frames(self, frames, method):
+        """
+        Combines the given aligned frames into a single image, using either the mean or the median of the frames.
+        :param frames: a uint8 array with shape (N, H, W, 3) of aligned frames
+        :param method: 'mean' or 'median'
+        :return: the combined uint8 image
+        """
+        if method == 'median':
+            return np.median(frames, axis=0).astype(np.uint8)
+        return np.mean(frames, axis=0, dtype=np.float32).astype(np.uint8)
+
+    def combine_method(self):
+        """
+        :return: 'median' or 'mean', according to the user's selection
+        """
+        return 'median' if self.med_mean_var.get() == 1 else 'mean'
 
     def update_focus_parameters(self):
         """
@@ -200,41 +332,55 @@ class GUI(tk.Frame):
             self.dy = float(self.y_entry.get())
             self.y_entry.delete(0, 'end')
 
-    def align_images(self):
+    @traced('align_images')
+    def align_images(self, frames, im_shape, trajectory, ref_frame, progress=None):
         """
-        Aligns all images in the sequence with respect to the reference frame
+        Aligns all images in the sequence with respect to the reference frame. The aligned frames are stored as a uint8
+        array of shape (N, H, W, 3), so every aligned frame is a contiguous block.
+        :param frames: the frames of the sequence
+        :param im_shape: the shape of a frame
+        :param trajectory: the MotionTrajectory of the sequence
+        :param ref_frame: the index of the reference frame
+        :param progress: see JobRunner
+        :return: the aligned frames - a tuple of the homographies from the reference frame to every frame, the array of
+                the aligned frames and an array for the shifted frames (None until it is first allocated by refocus_im)
         """
-        self.warped_im = np.zeros(self.im_shape + (self.num_frames,))
-
-        # compute the accumulate homographies of each frame with respect to the reference frame
-        accum_homographies = accumulate_homographies(self.homographies, self.ref_frame)
+        # compute the homographies from the reference frame to each frame, which are the inverses of the accumulated
+        # homographies of each frame with respect to the reference frame
+        h_invs = list(trajectory.from_reference(ref_frame).transpose(2, 0, 1))
 
         # warp images according to homographies:
-        for i in range(self.num_frames):
-            h_inv = np.linalg.inv(accum_homographies[:, :, i])
-            self.warped_im[:, :, :, i] = cv2.warpPerspective(self.frames[i], h_inv,
-                                                             (self.im_shape[1], self.im_shape[0]))
-        self.refocused_im = copy.deepcopy(self.warped_im)
+        warped_im = warp_frames(frames, h_invs, im_shape, num_workers=NUM_WORKERS, progress=progress)
+        return h_invs, warped_im, None
 
-    def load_dir(self):
+    def load_dir(self, video=False):
         """
-        Loads the dir the user selected and displays the number of frames in it and the size of an image
+        Loads the dir (or the video file) the user selected and displays the number of frames in it and the size of an
+        image
+        :param video: if True, the user selects a video file (see VIDEO_EXTENSIONS) instead of a folder of images
         """
         try:
             try:
                 self.load_label.destroy()
             except AttributeError:
                 pass
+            self.jobs.cancel()
             self.reset_fields()
-            self.directory = filedialog.askdirectory(initialdir=os.path.sep, title="select dir") + os.path.sep
-            self.file_name = self.directory.split(os.path.sep)[-2]
+            if video:
+                self.directory = filedialog.askopenfilename(initialdir=os.path.sep, title="select video", filetypes=[
+                    ('Videos', ' '.join('*' + extension for extension in VIDEO_EXTENSIONS))])
+            else:
+                self.directory = filedialog.askdirectory(initialdir=os.path.sep, title="select dir") + os.path.sep
+            self.file_name = sequence_name(self.directory)
 
             # load frames:
-            self.frames = load_images(self.directory)
+            self.frames = open_frames(self.directory, os.path.join("..", "Frames"), lazy=LAZY_FRAMES,
+                                      num_workers=NUM_WORKERS)
+            self.pyramid = FramePyramid(self.frames)
             if self.frames:
                 self.num_frames = len(self.frames)
                 self.im_shape = self.frames[0].shape
-                self.load_label = self.add_label(text=f'Folder Name: {self.file_name}\n'
+                self.load_label = self.add_label(text=f'Sequence Name: {self.file_name}\n'
                                                       f'Number of Frames: {len(self.frames)}\n'
                                                       f'Frame size: {self.im_shape[0]}x{self.im_shape[1]}',
                                                  place=[200, 10],
@@ -250,24 +396,35 @@ class GUI(tk.Frame):
     def compute_motion(self):
         """
         Calculates the motion between every two consecutive frames in the sequence and saves it in a file
-        '/Motion/<sequence_name>.csv'. If the file already exists, it loads this file instead of recomputing the motion.
+        '/Motion/<sequence_name>-<parameters hash>.npz'. If the file already exists, it loads this file instead of
+        recomputing the motion, and only recomputes the motion of frames that changed since the file was saved.
+        The motion is computed in the background.
         """
         try:
             if not self.directory:
                 raise UserError('Please load a folder first!')
-            self.homographies = np.genfromtxt(os.path.join("..", "Motion", self.file_name + '.csv'),
-                                              delimiter=',').reshape((3, 3, self.num_frames - 1))
+            frames, directory, file_name = self.frames, self.directory, self.file_name
+            translation_only = self.trans_only_var.get()
+
+            def work(job):
+                features = FeatureStore(frames, num_workers=NUM_WORKERS, indices=[])
+                homographies = load_or_compute_motion(frames, frame_keys(directory, num_frames=len(frames)),
+                                                      os.path.join("..", "Motion"),
+                                                      file_name, translation_only=translation_only,
+                                                      num_workers=NUM_WORKERS, features=features, progress=job.report)
+                return features, homographies
+
+            def done(result):
+                if self.directory == directory:
+                    self.features, self.homographies = result
+                    self.aligned = None
+
+            self.jobs.submit('Computing motion', work, done,
+                             lambda e: display_error(root, 'Error occurred while computing motion. Error: ' + str(e)))
+
         except UserError as e:  # catch the error if the user didn't load a folder
             display_error(root, e.message)
 
-        except IOError:  # no motion file exists - catch the IOError, calculate and save the motion
-            self.homographies = np.zeros((3, 3, self.num_frames - 1))
-            for i in range(self.num_frames - 1):
-                self.homographies[:, :, i] = Homography(self.frames[i], self.frames[i + 1],
-                                                        translation_only=self.trans_only_var.get())
-            csv_data = self.homographies.reshape((9, self.num_frames - 1))
-            np.savetxt(os.path.join("..", "Motion", self.file_name + '.csv'), csv_data, delimiter=',')
-
         except Exception as e:
             display_error(root, 'Error occurred while computing motion. Error: ' + e.args[0])
 
@@ -290,49 +447,56 @@ class GUI(tk.Frame):
         select_window.mainloop()
 
     def done_selecting(self, window, select_window):
+        error_message = 'Not enough feature points in the selected area. Please select a larger area'
         try:
-            try:
-                self.current_im_label.destroy()
-            except AttributeError:
-                pass
             self.selection_area[0] = min(select_window.posn_tracker.start[1], select_window.posn_tracker.end[1])
             self.selection_area[1] = max(select_window.posn_tracker.start[1], select_window.posn_tracker.end[1])
             self.selection_area[2] = min(select_window.posn_tracker.start[0], select_window.posn_tracker.end[0])
             self.selection_area[3] = max(select_window.posn_tracker.start[0], select_window.posn_tracker.end[0])
             window.destroy()
-
-            # Calculate homography of every frame with ref frame
-            self.homographies = np.zeros((3, 3, self.num_frames))
-            for i in range(self.num_frames):
-                self.homographies[:, :, i] = Homography(self.frames[i], self.frames[self.ref_frame],
-                                                        selection_area=self.selection_area,
-                                                        translation_only=self.trans_only_var.get())
-
-            # Warp images according to homographies:
-            warped_frames = np.zeros(self.frames[self.ref_frame].shape + (self.num_frames,))
-            for i in range(self.num_frames):
-                h_inv = np.linalg.inv(self.homographies[:, :, i])
-                warped_frames[:, :, :, i] = cv2.warpPerspective(self.frames[i], h_inv,
-                                                                (self.frames[self.ref_frame].shape[1],
-                                                                 self.frames[self.ref_frame].shape[0]))
-
-            # Use either mean or median for the refocused image, according to the user's selection
-            if self.med_mean_var.get() == 1:
-                refocused_im = np.median(warped_frames, axis=3).astype(np.uint8)
-            else:
-                refocused_im = np.mean(warped_frames, axis=3).astype(np.uint8)
-
-            # display the image to the user in a new window
-            window = Toplevel(root)
-            window.title('Refocused Image')
-            img = ImageTk.PhotoImage(Image.fromarray(BGR2RGB(refocused_im)))
-            canvas = tk.Canvas(window, width=img.width(), height=img.height(),
-                               borderwidth=0, highlightthickness=0)
-            canvas.pack(expand=True)
-            canvas.create_image(0, 0, image=img, anchor=tk.NW)
-            canvas.img = img
+            selection_area, directory = list(self.selection_area), self.directory
+            translation_only, method = self.trans_only_var.get(), self.combine_method()
+            frames, pyramid, im_shape, ref_frame = self.frames, self.pyramid, self.im_shape, self.ref_frame
+            features, num_frames = self.features, self.num_frames
+
+            def work(job):
+                # Calculate homography of every frame with ref frame, using only the features in the selected area
+                area_features = features
+                if area_features is None:
+                    area_features = FeatureStore(frames, num_workers=NUM_WORKERS, indices=[])
+                    area_features.detect(range(num_frames), num_workers=NUM_WORKERS, progress=job.report)
+                ref_features = area_features.select(ref_frame, selection_area)
+                homographies = np.zeros((3, 3, num_frames))
+                for i in range(num_frames):
+                    homographies[:, :, i] = match_features(*ref_features, *area_features.select(i, selection_area),
+                                                           translation_only=translation_only)
+                    job.report(i + 1, num_frames)
+                if PROGRESSIVE_PREVIEW:
+                    for factor in PREVIEW_FACTORS:
+                        job.preview((factor, self.compute_preview(pyramid, im_shape, homographies, factor,
+                                                                  method=method)))
+
+                # Warp images according to homographies, and use either mean or median for the refocused image
+                return area_features, homographies, refocus(frames, homographies, im_shape, method=method,
+                                                            progress=job.report, num_workers=NUM_WORKERS)
+
+            new_window = True
+
+            def show(refocused_im, title='Refocused Image'):
+                nonlocal new_window
+                if self.directory == directory:
+                    self.show_refocused_im(refocused_im, new_window=new_window, title=title)
+                    new_window = False
+
+            def done(result):
+                if self.directory == directory:
+                    self.features, self.homographies = result[:2]
+                    show(result[2])
+
+            self.jobs.submit('Refocusing on area', work, done, lambda e: display_error(root, error_message),
+                             lambda preview: show(preview[1], f'Refocused Image (preview 1/{preview[0]})'))
         except:
-            display_error(root, 'Not enough feature points in the selected area. Please select a larger area')
+            display_error(root, error_message)
         self.selection_area = [0, 0, 0, 0]
 
     def add_label(self, text: str, place: list, borderwidth: int = 0):
@@ -365,6 +529,7 @@ class GUI(tk.Frame):
 
 if __name__ == '__main__':
     os.system(f'mkdir {os.path.join("..", "Motion")}')
+    os.system(f'mkdir {os.path.join("..", "Frames")}')
 
     WIDTH, HEIGHT = 500, 350
     BACKGROUND = 'grey'
@@ -1,5 +1,7 @@
 from tkinter import filedialog
 from Code.GUI_helper import *
+from Code.frame_sources import *
+from Code.xslits_engine import *
 
 dirname = os.path.dirname(__file__)
 
@@ -10,8 +12,11 @@ class GUI(tk.Frame):
         self.directory = ''
         self.file_name = ''
         self.frames = []
+        self.pyramid = None
         self.num_frames = 0
         self.homographies = None
+        self.features = None
+        self.frame_keys = []
         self.start_frame = 0
         self.end_frame = 0
         self.initial_start_frame = 0
@@ -35,13 +40,19 @@ class GUI(tk.Frame):
         self.rotate_angle_label = None
         self.load_label = None
         self.add_button(text='Show', place=[200, 360], command=self.create_slit)
+        self.progress_label = self.add_label(text='', place=[310, 363])
+        self.jobs = JobRunner(self, self.progress_label)
+        self.add_button(text='Cancel', place=[245, 360], command=self.jobs.cancel)
+        if PROFILING:
+            self.add_button(text='Stats', place=[15, 360], command=lambda: display_stats(root))
 
     def select_folder_button(self):
         """
         Creates the folder selection label and button in the GUI.
         """
-        self.add_label(text='Select images folder:', place=[15, 10])
+        self.add_label(text='Select images folder or video:', place=[15, 10])
         self.add_button(text="Select Folder", fg="black", command=self.load_dir, place=[15, 30])
+        self.add_button(text="Select Video", fg="black", command=lambda: self.load_dir(video=True), place=[110, 30])
 
     def motion_button(self):
         """
@@ -49,6 +60,20 @@ class GUI(tk.Frame):
         """
         self.add_label(text='Press the button to calculate the motion between frames:', place=[15, 70])
         self.add_button(text='Compute Motion', place=[15, 90], command=self.compute_motion)
+        self.phase_correlation_checkbutton()
+
+    def phase_correlation_checkbutton(self):
+        """
+        Displays the phase correlation checkbutton, which allows the user to estimate the motion of the current sequence
+        by phase correlation of the frames (see MOTION_ESTIMATORS). It is faster than matching ORB features, but may
+        follow a different motion on sequences with several moving layers, which is partly corrected by spot checks with
+        ORB features (see PHASE_CORRELATION_CHECK_EVERY).
+        """
+        self.phase_correlation_var = IntVar()
+        phase_correlation_button = Checkbutton(self, text="Phase Correlation", variable=self.phase_correlation_var,
+                                               onvalue=1, offvalue=0, height=1, width=15)
+        phase_correlation_button.pack()
+        phase_correlation_button.place(x=180, y=93)
 
     def select_slice(self):
         """
@@ -73,24 +98,36 @@ class GUI(tk.Frame):
         self.add_label(text='Zoom in/out (degree)', place=[350, 250])
         self.rotate_slit_entry = self.add_entry(place=[400, 270], width=4)
 
-    def load_dir(self):
+    def load_dir(self, video=False):
         """
-        Loads the dir the user selected and displays the number of frames in it and the size of an image
+        Loads the dir (or the video file) the user selected and displays the number of frames in it and the size of an
+        image
+        :param video: if True, the user selects a video file (see VIDEO_EXTENSIONS) instead of a folder of images
         """
         try:
             try:
                 self.load_label.destroy()
             except AttributeError:
                 pass
-            self.directory = filedialog.askdirectory(initialdir=os.path.sep, title="select dir") + os.path.sep
-            self.file_name = self.directory.split(os.path.sep)[-2]
+            self.jobs.cancel()
+            if video:
+                self.directory = filedialog.askopenfilename(initialdir=os.path.sep, title="select video", filetypes=[
+                    ('Videos', ' '.join('*' + extension for extension in VIDEO_EXTENSIONS))])
+            else:
+                self.directory = filedialog.askdirectory(initialdir=os.path.sep, title="select dir") + os.path.sep
+            self.file_name = sequence_name(self.directory)
+            self.homographies = None
+            self.features = None
+            self.pyramid = None
 
             # load frames:
-            self.frames = load_images(self.directory)
+            self.frames = open_frames(self.directory, os.path.join("..", "Frames"), lazy=LAZY_FRAMES,
+                                      num_workers=NUM_WORKERS)
+            self.frame_keys = frame_keys(self.directory, num_frames=len(self.frames))
             if self.frames:
                 self.num_frames = len(self.frames)
                 self.im_shape = self.frames[0].shape
-                self.load_label = self.add_label(text=f'Folder Name: {self.file_name}\n'
+                self.load_label = self.add_label(text=f'Sequence Name: {self.file_name}\n'
                                                       f'Number of Frames: {len(self.frames)}\n'
                                                       f'Frame size: {self.im_shape[0]}x{self.im_shape[1]}',
                                                  place=[200, 10], borderwidth=2)
@@ -103,176 +140,150 @@ class GUI(tk.Frame):
     def compute_motion(self):
         """
         Calculates the motion between every two consecutive frames in the sequence and saves it in a file
-        '/Motion/<sequence_name>.csv'. If the file already exists, it loads this file instead of recomputing the motion.
+        '/Motion/<sequence_name>-<parameters hash>.npz'. If the file already exists, it loads this file instead of
+        recomputing the motion, and only recomputes the motion of frames that changed since the file was saved.
+        The motion is computed in the background.
         """
         try:
             if not self.directory:
                 raise UserError('Please load a folder first!')
+            directory = self.directory
+            estimator = 'phase' if self.phase_correlation_var.get() else 'orb'
 
-            self.homographies = np.genfromtxt(os.path.join("..", "Motion", self.file_name + '.csv'),
-                                              delimiter=',').reshape((3, 3, self.num_frames - 1))
-            self.validate_motion_direction()
+            def work(job):
+                frames, keys = self.validate_motion_direction(self.frames, self.frame_keys)
+                features = FeatureStore(frames, num_workers=NUM_WORKERS, indices=[])
+                homographies = load_or_compute_motion(frames, keys, os.path.join("..", "Motion"), self.file_name,
+                                                      translation_only=True, num_workers=NUM_WORKERS,
+                                                      features=features, progress=job.report, estimator=estimator)
+                return frames, keys, features, homographies
+
+            def done(result):
+                if self.directory == directory:
+                    self.frames, self.frame_keys, self.features, self.homographies = result
+                    self.pyramid = FramePyramid(self.frames)
+
+            self.jobs.submit('Computing motion', work, done,
+                             lambda e: display_error(root, 'Error occurred while computing motion. Error: ' + str(e)))
 
         except UserError as e:  # catch the error if the user didn't load a folder
             display_error(root, e.message)
 
-        except IOError as e:  # no motion file exists - catch the IOError, calculate and save the motion
-            self.validate_motion_direction()
-            self.homographies = np.zeros((3, 3, self.num_frames - 1))
-            for i in range(self.num_frames - 1):
-                self.homographies[:, :, i] = Homography(self.frames[i], self.frames[i + 1], translation_only=True)
-            csv_data = self.homographies.reshape((9, self.num_frames - 1))
-            np.savetxt(os.path.join("..", "Motion", self.file_name + '.csv'), csv_data, delimiter=',')
-
         except Exception as e:
             display_error(root, 'Error occurred while computing motion. Error: ' + e.args[0])
 
-    def validate_motion_direction(self):
+    def validate_motion_direction(self, frames, keys):
         """
         Validates that the given sequence is taken from left to right. If the sequence was taken from right to left,
         this function reverses the frames.
+        :param frames: the frames of the sequence
+        :param keys: the keys of the frames (see frame_keys)
+        :return: the frames and their keys, ordered from left to right
         """
-        test_num = max(int(len(self.frames) // 10), 1)
+        test_num = max(int(len(frames) // 10), 1)
         test_homographies = np.zeros((3, 3, test_num))
         for i in range(test_num):
-            test_homographies[:, :, i] = Homography(self.frames[i], self.frames[i + 1], translation_only=True)
+            test_homographies[:, :, i] = Homography(frames[i], frames[i + 1], translation_only=True)
         if np.sum(test_homographies[0, 2, :]) < 0:
-            self.frames = self.frames[::-1]
+            return frames[::-1], keys[::-1]
+        return frames, keys
 
     def create_slit(self):
         """
         Calculates the panorama slit according to the values specified by the user and saves the image to the user.
+        The panorama is created in the background. If PROGRESSIVE_PREVIEW is set, previews created from the downscaled
+        frames are displayed first.
         """
         try:
             if self.homographies is None:
                 raise UserError('Please compute the motion between frames first!')
-            try:
-                self.current_slit_label.destroy()
-            except AttributeError:
-                pass
-            try:
-                panorama_im = self.create_panorama()
-                if panorama_im.shape[1] == 0:
-                    raise UserError('Could not create panorama image using the defined slice. Please select different '
-                                    'end points.')
-            except Exception as e:
-                raise e
-            window = Toplevel(root)
-            window.title('Panorama Image')
-            img = ImageTk.PhotoImage(Image.fromarray(BGR2RGB(panorama_im)))
-            canvas = tk.Canvas(window, width=img.width(), height=img.height(),
-                               borderwidth=0, highlightthickness=0)
-            canvas.pack(expand=True)
-            canvas.create_image(0, 0, image=img, anchor=tk.NW)
-            canvas.img = img
-            label_text = f'Current slit - frames: {self.start_frame}-{self.end_frame}, columns: {self.start_column}-' \
-                         f'{self.end_column}'
-            self.current_slit_label = self.add_label(text=label_text, place=[100, 330], borderwidth=2)
-        except UserError as e:
-            display_error(root, e.message, e.orig_err_msg)
+            self.update_slit_boundaries()
+            if not self.check_boundaries():
+                raise UserError(f'Please define valid starting and ending frames and columns!\n'
+                                f'Frames range 0-{self.num_frames-1}, Columns range 0-{self.im_shape[1]-1}')
+            slit = (self.start_frame, self.end_frame, self.start_column, self.end_column)
+            directory = self.directory
+            window = None
+
+            def work(job):
+                if PROGRESSIVE_PREVIEW:
+                    for factor in PREVIEW_FACTORS:
+                        # the rounded columns and motion of a downscaled slit may not make a legal panorama even when
+                        # the full resolution slit does, so a preview that fails is skipped
+                        try:
+                            preview = self.create_panorama(*slit, factor=factor)
+                        except JobCancelled:
+                            raise
+                        except Exception:
+                            continue
+                        job.preview((factor, cv2.resize(preview, None, fx=factor, fy=factor,
+                                                        interpolation=cv2.INTER_LINEAR)))
+                return self.create_panorama(*slit)
+
+            def show(panorama_im, title='Panorama Image'):
+                nonlocal window
+                if self.directory == directory:
+                    window = self.show_panorama(panorama_im, slit, title, window)
+
+            self.jobs.submit('Creating panorama', work, show, self.panorama_error,
+                             lambda preview: show(preview[1], f'Panorama Image (preview 1/{preview[0]})'))
         except Exception as e:
-            display_error(root, 'Error occurred while creating panorama. Error: ' + e.args[0])
+            self.panorama_error(e)
 
-    def create_panorama(self):
+    def panorama_error(self, e):
         """
-        Checks if the start column is bigger than the end column and creates a new panorama image accordingly.
-        :return: the new panorama image
+        Displays the error that occurred while creating a panorama to the user.
         """
-        self.update_slit_boundaries()
-        if not self.check_boundaries():
-            raise UserError(f'Please define valid starting and ending frames and columns!\n'
-                            f'Frames range 0-{self.num_frames-1}, Columns range 0-{self.im_shape[1]-1}')
-        try:
-            if self.start_column <= self.end_column:
-                return self.create_panorama_small_start()
-            else:
-                return self.create_panorama_big_start()
-        except Exception as e:
-            raise UserError('Could not create panorama image using the defined slice. Please select different end '
-                            'points.', e.args[0])
+        if isinstance(e, UserError):
+            display_error(root, e.message, e.orig_err_msg)
+        else:
+            display_error(root, 'Error occurred while creating panorama. Error: ' + str(e))
 
-    def create_panorama_small_start(self):
+    def show_panorama(self, panorama_im, slit, title='Panorama Image', window=None):
         """
-        Creates a new panorama image in the case where the starting column is smaller than the ending column
-        :return: the new panorama image
-        """
-        if self.start_frame == self.end_frame:
-            return self.frames[self.start_frame][:, self.start_column:self.end_column, :]
-        col_range = self.end_column - self.start_column
-        total_motion = int(np.sum(np.round(self.homographies[0, 2, self.start_frame:self.end_frame])))
-        first_motion = int(round(self.homographies[0, 2, self.start_frame]))
-        num_frames = self.end_frame - self.start_frame + 1
-        start_pos = calculate_added_motion(self.start_column + first_motion, self.end_column, num_frames)
-        panorama_width = total_motion + col_range
-        panorama_im = np.zeros((self.im_shape[0], panorama_width, self.im_shape[2])).astype(np.uint8)
-        panorama_col = 0
-
-        if self.start_column == self.end_column:
-            for i in range(num_frames - 1):
-                motion = int(round(self.homographies[0, 2, self.start_frame + i]))
-                if self.start_column + motion < self.im_shape[1]:
-                    panorama_im[:, panorama_col: panorama_col + motion, :] = \
-                        self.frames[self.start_frame + i][:, self.start_column: self.start_column + motion, :]
-                else:
-                    panorama_im[:, panorama_col: panorama_col + motion, :] = \
-                        self.frames[self.start_frame + i][:, self.im_shape[1] - motion:, :]
-                panorama_col += motion
-            return panorama_im
-
-        if self.end_column - self.start_column < first_motion and self.end_column != self.start_column:
-            panorama_im[:, : self.end_column - self.start_column, :] = self.frames[self.start_frame][:, self.start_column: self.end_column, :]
-            panorama_col += self.end_column - self.start_column
-            self.end_column = self.start_column
-            panorama_im[:, panorama_col:, :] = self.create_panorama_small_start()
-            return panorama_im
-
-        panorama_im[:, : start_pos[1] - start_pos[0] + first_motion, :] = \
-            self.frames[self.start_frame][:, start_pos[0] - first_motion: start_pos[1], :]
-        panorama_col += start_pos[1] - start_pos[0] + first_motion
-
-        for i in range(1, num_frames):
-            motion = int(round(self.homographies[0, 2, self.start_frame + i - 1]))
-            panorama_im[:, panorama_col: panorama_col + start_pos[i + 1] - start_pos[i] + motion, :] = \
-                self.frames[self.start_frame + i][:, start_pos[i] - motion: start_pos[i + 1], :]
-            panorama_col += start_pos[i + 1] - start_pos[i] + motion
-        return panorama_im
-
-    def create_panorama_big_start(self):
+        Displays the given panorama to the user.
+        :param panorama_im: the panorama image
+        :param slit: the (start_frame, end_frame, start_column, end_column) of the slit of the panorama
+        :param title: the title of the window
+        :param window: the window in which the panorama should be displayed. If None, a new window is opened.
+        :return: the window displaying the panorama
         """
-        Creates a new panorama image in the case where the starting column is bigger than the ending column
+        try:
+            self.current_slit_label.destroy()
+        except AttributeError:
+            pass
+        window = display_image(root, panorama_im, title, window)
+        label_text = f'Current slit - frames: {slit[0]}-{slit[1]}, columns: {slit[2]}-{slit[3]}'
+        self.current_slit_label = self.add_label(text=label_text, place=[100, 330], borderwidth=2)
+        return window
+
+    @traced('create_panorama')
+    def create_panorama(self, start_frame, end_frame, start_column, end_column, factor=1):
+        """
+        Creates a new panorama image defined by the given end points (see xslits_engine). This function runs in the
+        background and must not use tkinter.
+        :param start_frame: the first frame of the slit
+        :param end_frame: the last frame of the slit
+        :param start_column: the column of the slit in the first frame
+        :param end_column: the column of the slit in the last frame
+        :param factor: the factor by which the frames are downscaled for creating the panorama. The motion computed on
+                the full resolution frames is rescaled to the downscaled frames.
         :return: the new panorama image
         """
-        if self.start_frame == self.end_frame:
-            return self.frames[self.start_frame][:, self.end_column: self.start_column + 1, :]
-        total_motion = int(np.sum(np.round(self.homographies[0, 2, self.start_frame:self.end_frame])))
-        num_frames = self.end_frame - self.start_frame + 1
-        num_cols = self.start_column - self.end_column + 1
-        first_motion = int(round(self.homographies[0, 2, self.start_frame]))
-        cur_start = self.start_column - first_motion
-        panorama_width = total_motion
-        if panorama_width <= 0:
-            raise Exception('illegal panorama')
-        panorama_im = np.zeros((self.im_shape[0], panorama_width, self.im_shape[2])).astype(np.uint8)
-        panorama_col = 0
-        for i in range(self.end_frame - self.start_frame - 1):
-            added_motion = (num_cols - first_motion) // (num_frames - 2)
-            next_motion = int(round(self.homographies[0, 2, self.start_frame + i + 1]))
-            if i < ((num_cols - first_motion) % (num_frames - 2)):
-                added_motion += 1
-            cur_end = cur_start + next_motion - added_motion
-            if cur_end < cur_start:
-                cur_start, cur_end = cur_end, cur_start
-            slit_width = cur_end - cur_start
-            if cur_end > self.start_column:
-                cur_end = self.start_column
-                cur_start = cur_end - slit_width
-            if cur_start < self.end_column:
-                cur_start = self.end_column
-                cur_end = cur_start + slit_width
-            panorama_im[:, panorama_col: panorama_col + slit_width, :] = self.frames[self.start_frame + i][:, cur_start:cur_end, :]
-            panorama_col += slit_width
-            cur_start -= added_motion
-        panorama_im = np.delete(panorama_im, np.where((panorama_im == 0).all(0)), axis=1)
+        frames, homographies = self.frames, self.homographies
+        if factor != 1:
+            frames = self.pyramid.level(factor, num_workers=NUM_WORKERS)
+            scale = frames.shape[2] / self.im_shape[1]
+            homographies = scale_homographies(homographies, scale, frames.shape[1] / self.im_shape[0])
+            start_column, end_column = int(round(start_column * scale)), int(round(end_column * scale))
+        try:
+            panorama_im = create_panorama(frames, homographies, start_frame, end_frame, start_column, end_column)
+        except Exception as e:
+            raise UserError('Could not create panorama image using the defined slice. Please select different end '
+                            'points.', e.args[0])
+        if panorama_im.shape[1] == 0:
+            raise UserError('Could not create panorama image using the defined slice. Please select different '
+                            'end points.')
         return panorama_im
 
     def check_boundaries(self):
@@ -387,6 +398,7 @@ class GUI(tk.Frame):
 
 if __name__ == '__main__':
     os.system(f'mkdir {os.path.join("..", "Motion")}')
+    os.system(f'mkdir {os.path.join("..", "Frames")}')
 
     WIDTH, HEIGHT = 500, 400
     BACKGROUND = 'grey'
@@ -0,0 +1,273 @@
+from Code.GUI_helper import *
+from Code.refocus_engine import *
+from Code.xslits_engine import *
+from Code.utils import validate_motion_direction
+import argparse
+import json
+import resource
+import sys
+import time
+import tracemalloc
+
+
+# This file contains a benchmark of every stage of the refocusing and X-Slits tasks over the sequences in the Data
+# folder. Every stage is reported with its time, its throughput (frames or pairs per second and megapixels per second)
+# and the peak memory it allocated, and the report can be compared against a stored baseline, e.g.:
+#   python -m Code.benchmark --save-baseline benchmark-baseline.json
+#   python -m Code.benchmark --baseline benchmark-baseline.json
+# The exit status is 1 if a stage of a sequence became slower than its baseline by more than the tolerance.
+
+BENCHMARK_SEQUENCES = ('Banana', 'Lego', 'Nutella', 'Treasure', 'apples', 'EmekRefaim', 'train-in-snow')
+
+# The number of panoramas created by the panorama stages, so their time is long enough to be measured
+BENCHMARK_PANORAMAS = 20
+
+
+def measure(function, num_items, num_pixels, repeat=1):
+    """
+    Measures the given stage. The stage is timed without tracing memory, which would slow it down, and then run once
+    more with tracemalloc for its peak traced memory.
+    :param function: the stage, a function without arguments
+    :param num_items: the number of items (frames, pairs or panoramas) processed by the stage
+    :param num_pixels: the number of pixels processed by the stage
+    :param repeat: the stage is run repeat times and the fastest run is reported
+    :return: the result of the stage and its record - the time in seconds, the time per item, the items per second,
+            the megapixels per second, the peak memory allocated by the stage in MB as traced by tracemalloc (Python
+            and NumPy allocations) and the growth of the peak resident memory of the process in MB during the timed
+            runs, which includes the buffers allocated by OpenCV (None where the peak resident memory can't be reset)
+    """
+    seconds = []
+    rss_base = reset_peak_rss()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    peak_rss = None if rss_base is None else (read_proc_status('VmHWM') - rss_base) / 2 ** 20
+
+    tracemalloc.start()
+    try:
+        function()
+        peak_traced = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+    seconds = min(seconds)
+    return result, {'seconds': seconds, 'seconds_per_item': seconds / max(num_items, 1),
+                    'items_per_s': num_items / seconds, 'megapixels_per_s': num_pixels / 1e6 / seconds,
+                    'peak_traced_mb': peak_traced, 'peak_rss_mb': peak_rss}
+
+
+def read_proc_status(field):
+    """
+    :return: the given memory field (e.g. 'VmRSS') of /proc/self/status in bytes, or None if it is not available
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory of the process to its current resident memory (Linux only).
+    :return: the current resident memory in bytes, or None if the peak can't be reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return None
+    return read_proc_status('VmRSS')
+
+
+def benchmark_sequence(dir, max_frames=None, num_workers=1, repeat=1):
+    """
+    Benchmarks all the stages on the given sequence.
+    :param dir: the directory of the frames of the sequence
+    :param max_frames: if given, only the first max_frames frames of the sequence are used
+    :param num_workers: the number of threads used by the stages which run in parallel
+    :param repeat: see measure
+    :return: a dictionary with the number and shape of the frames and the record of every stage (see measure). A stage
+            which can't run on the sequence (e.g. an illegal panorama) is recorded with an error message instead, and
+            the stages whose input failed are recorded as skipped.
+    """
+    images_path = list_images(dir)[:max_frames]
+    num_frames = len(images_path)
+    frames, load = measure(lambda: read_images(images_path, num_workers=num_workers), num_frames, 0, repeat)
+    shape = frames[0].shape
+    frame_pixels = shape[0] * shape[1]
+    load['megapixels_per_s'] = num_frames * frame_pixels / 1e6 / load['seconds']
+    stages = {'load_images': load}
+
+    def run(name, function, num_items, num_pixels, inputs=()):
+        # a stage whose inputs failed is recorded as skipped
+        if any(value is None for value in inputs):
+            stages[name] = {'error': 'skipped, its input failed'}
+            return None
+        try:
+            result, stages[name] = measure(function, num_items, num_pixels, repeat)
+            return result
+        except Exception as e:
+            stages[name] = {'error': f'{type(e).__name__}: {e}'}
+
+    def setup(name, function, inputs=()):
+        # the input of the following stages, which isn't measured. If it fails, it is recorded like a failed stage.
+        if any(value is None for value in inputs):
+            return None
+        try:
+            return function()
+        except Exception as e:
+            stages[name] = {'error': f'{type(e).__name__}: {e}'}
+
+    num_pairs = num_frames - 1
+    homographies = run('compute_homographies', lambda: compute_homographies(frames, num_workers=num_workers, seed=0),
+                       num_pairs, num_pairs * frame_pixels)
+    for estimator in MOTION_ESTIMATORS:
+        run(f'translation_{estimator}', lambda: compute_homographies(frames, translation_only=True, seed=0,
+                                                                     num_workers=num_workers, estimator=estimator),
+            num_pairs, num_pairs * frame_pixels)
+
+    features = setup('setup_features', lambda: FeatureStore(frames, num_workers=num_workers))
+    for matcher in MATCHERS:
+        run(f'match_{matcher}', lambda: [match_points(*features[i + 1], *features[i], matcher=matcher)
+                                         for i in range(num_pairs)], num_pairs, 0, inputs=(features,))
+    matches = setup('setup_matches', lambda: [match_points(*features[i + 1], *features[i]) for i in range(num_pairs)],
+                    inputs=(features,))
+    run('ransac_homography', lambda: [ransac_homography(*pair_matches, RANSAC_NUM_ITER, RANSAC_INLIER_TOL, rng=i)
+                                      for i, pair_matches in enumerate(matches)], num_pairs, 0, inputs=(matches,))
+
+    ref_frame = num_frames // 2
+    run('accumulate_homographies', lambda: accumulate_homographies(homographies, ref_frame), num_frames, 0,
+        inputs=(homographies,))
+    run('motion_trajectory', lambda: MotionTrajectory(homographies).to_reference(ref_frame), num_frames, 0,
+        inputs=(homographies,))
+
+    trajectory = setup('setup_trajectory', lambda: MotionTrajectory(homographies), inputs=(homographies,))
+    accum_homographies = None if trajectory is None else trajectory.to_reference(ref_frame)
+    h_invs = None if trajectory is None else list(trajectory.from_reference(ref_frame).transpose(2, 0, 1))
+    run('align_images', lambda: warp_frames(frames, h_invs, shape, num_workers=num_workers), num_frames,
+        num_frames * frame_pixels, inputs=(h_invs,))
+    for method in ('mean', 'median'):
+        run(f'refocus_{method}', lambda: refocus(frames, accum_homographies, shape, dx=1, method=method,
+                                                 num_workers=num_workers), num_frames, num_frames * frame_pixels,
+            inputs=(accum_homographies,))
+
+    # the panoramas are created from the translations of the frames ordered from left to right
+    def panorama_inputs():
+        ordered_frames, _ = validate_motion_direction(frames, list(range(num_frames)))
+        translations = compute_homographies(ordered_frames, translation_only=True, num_workers=num_workers, seed=0)
+        return ordered_frames, translations, MotionTrajectory(translations).x_motion(0, num_pairs)
+
+    inputs = setup('setup_panoramas', panorama_inputs)
+    ordered_frames, translations, total_motion = (None, None, None) if inputs is None else inputs
+    width = shape[1]
+    columns = min(width // 4, max((total_motion or 0) // 2, 1))
+    for name, start_column, end_column in (('small_start', width // 4, width // 4 + columns),
+                                           ('big_start', width // 2 + columns // 2, width // 2 - columns // 2)):
+        end_points = [(0, num_frames - 1, start_column + i, end_column + i) for i in range(BENCHMARK_PANORAMAS)]
+        panoramas = run(f'create_panorama_{name}',
+                        lambda: [create_panorama(ordered_frames, translations, *points) for points in end_points],
+                        BENCHMARK_PANORAMAS, 0, inputs=(inputs,))
+        if panoramas is not None:
+            stages[f'create_panorama_{name}']['megapixels_per_s'] = \
+                sum(im.shape[0] * im.shape[1] for im in panoramas) / 1e6 / stages[f'create_panorama_{name}']['seconds']
+    return {'num_frames': num_frames, 'frame_shape': list(shape), 'stages': stages}
+
+
+def compare(report, baseline, tolerance=0.25):
+    """
+    Compares the times of the stages in the given report with the baseline.
+    :param report: the benchmark report (see run_benchmark)
+    :param baseline: a previous report
+    :param tolerance: the fraction by which a stage may be slower than its baseline
+    :return: a list of (sequence, stage, ratio) of the stages which were slower than their baseline by more than the
+            tolerance, where ratio is the time of the stage divided by its baseline time
+    """
+    regressions = []
+    for sequence, result in report['sequences'].items():
+        base = baseline['sequences'].get(sequence)
+        if base is None or base['num_frames'] != result['num_frames']:
+            continue
+        for stage, record in result['stages'].items():
+            base_record = base['stages'].get(stage, {})
+            if 'seconds' in record and 'seconds' in base_record:
+                ratio = record['seconds'] / base_record['seconds']
+                record['baseline_ratio'] = ratio
+                if ratio > 1 + tolerance:
+                    regressions.append((sequence, stage, ratio))
+    return regressions
+
+
+def run_benchmark(data_dir, sequences=BENCHMARK_SEQUENCES, max_frames=None, num_workers=1, repeat=1, progress=None):
+    """
+    Benchmarks the given sequences.
+    :param data_dir: the directory which holds the folders of the sequences
+    :param sequences: the names of the sequences
+    :param progress: an optional function called as progress(sequence) before every sequence is benchmarked
+    :return: the benchmark report - the settings of the benchmark and the result of every sequence (see
+            benchmark_sequence)
+    """
+    results = {}
+    for sequence in sequences:
+        if progress:
+            progress(sequence)
+        results[sequence] = benchmark_sequence(os.path.join(data_dir, sequence), max_frames, num_workers, repeat)
+    return {'num_workers': num_workers, 'max_frames': max_frames, 'sequences': results,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def print_report(report):
+    """
+    Prints the report as a table.
+    """
+    print(f"{'sequence':<14}{'stage':<30}{'seconds':>9}{'per item':>10}{'items/s':>10}{'MP/s':>9}{'traced MB':>11}"
+          f"{'RSS MB':>9}{'vs base':>9}")
+    for sequence, result in report['sequences'].items():
+        for stage, record in result['stages'].items():
+            if 'error' in record:
+                print(f"{sequence:<14}{stage:<30}  {record['error']}")
+                continue
+            ratio = f"{record['baseline_ratio']:.2f}x" if 'baseline_ratio' in record else ''
+            rss = '' if record['peak_rss_mb'] is None else f"{record['peak_rss_mb']:.1f}"
+            print(f"{sequence:<14}{stage:<30}{record['seconds']:>9.3f}{record['seconds_per_item']:>10.4f}"
+                  f"{record['items_per_s']:>10.1f}{record['megapixels_per_s']:>9.1f}{record['peak_traced_mb']:>11.1f}"
+                  f"{rss:>9}{ratio:>9}")
+    print(f"max RSS: {report['max_rss_mb']:.0f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m Code.benchmark',
+                                     description='Benchmarks the stages of the refocusing and X-Slits tasks.')
+    parser.add_argument('--data', default='Data', help='the directory of the sequences')
+    parser.add_argument('--sequences', nargs='+', default=BENCHMARK_SEQUENCES)
+    parser.add_argument('--max-frames', type=int, default=None, help='use only the first frames of every sequence')
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS)
+    parser.add_argument('--repeat', type=int, default=1, help='report the fastest of this many runs of every stage')
+    parser.add_argument('--output', help='save the report as JSON in this file')
+    parser.add_argument('--baseline', help='compare the report against the baseline saved in this file')
+    parser.add_argument('--save-baseline', help='save the report as the baseline in this file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='the fraction by which a stage may be slower than its baseline')
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.data, args.sequences, args.max_frames, args.workers, args.repeat,
+                           progress=lambda sequence: print(f'benchmarking {sequence}', file=sys.stderr))
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+    print_report(report)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=1)
+    for sequence, stage, ratio in regressions:
+        print(f'REGRESSION {sequence} {stage}: {ratio:.2f}x slower than the baseline')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+from Code.GUI_helper import *
+from Code.frame_sources import *
+from Code.refocus_engine import *
+from Code.utils import *
+import argparse
+import json
+import sys
+import time
+
+
+# This file contains a headless command line interface for running the refocusing and X-Slits tasks on many sequences
+# without a display, e.g.:
+#   python -m Code.cli motion Data/Banana --motion-dir Motion --translation-only
+#   python -m Code.cli motion Data/apples --motion-dir Motion --frames-dir Frames --task xslits
+#   python -m Code.cli refocus Data/Banana --dx 1.5 --method median --out Results --motion-dir Motion
+#   python -m Code.cli xslits Data/apples --sweep cols --video --out Results --motion-dir Motion --frames-dir Frames
+# Every sequence is reported by a single JSON line on the standard output once it is done, and the exit status is 0 if
+# all the sequences succeeded and 1 otherwise.
+
+
+def load_sequence(dir, args, num_workers):
+    """
+    Opens the frames of the given sequence and computes (or loads) the motion between every two consecutive frames.
+    :return: the frames and the homographies between them
+    """
+    os.makedirs(args.motion_dir, exist_ok=True)
+    os.makedirs(args.frames_dir, exist_ok=True)
+    frames = open_frames(dir, args.frames_dir, lazy=True, num_workers=num_workers, stride=args.stride)
+    homographies = load_or_compute_motion(frames, frame_keys(dir, args.stride, len(frames)), args.motion_dir,
+                                          sequence_name(dir), translation_only=args.translation_only,
+                                          num_workers=num_workers, estimator=args.estimator)
+    return frames, homographies
+
+
+def motion_sequence(dir, args, num_workers):
+    """
+    Computes the motion of the given sequence and saves it in its motion file. For the X-Slits task, the motion is
+    computed like xslits does - translation only, between the frames ordered from left to right.
+    :return: the status of the sequence
+    """
+    if args.task == 'xslits':
+        frames, homographies = load_panorama_sequence(dir, args.motion_dir, args.frames_dir, lazy=True,
+                                                      stride=args.stride, num_workers=num_workers,
+                                                      estimator=args.estimator)
+    else:
+        frames, homographies = load_sequence(dir, args, num_workers)
+    translation_only = args.translation_only or args.task == 'xslits'
+    return {'num_frames': len(frames),
+            'output': motion_cache_path(args.motion_dir, sequence_name(dir), translation_only, args.estimator)}
+
+
+def refocus_sequence(dir, args, num_workers):
+    """
+    Computes the refocused image of the given sequence and saves it in '<out>/<sequence>_dx<dx>_dy<dy>_<method>.jpg'.
+    :return: the status of the sequence
+    """
+    frames, homographies = load_sequence(dir, args, num_workers)
+    # the default reference frame is the one used by the refocusing GUI, so both produce the same image
+    ref_frame = max(len(frames) // 2 - 1, 0) if args.ref_frame is None else args.ref_frame
+    accum_homographies = MotionTrajectory(homographies).to_reference(ref_frame)
+    refocused_im = refocus(frames, accum_homographies, frames[0].shape, dx=args.dx, dy=args.dy, method=args.method,
+                           num_workers=num_workers)
+    os.makedirs(args.out, exist_ok=True)
+    output = os.path.join(args.out, f'{sequence_name(dir)}_dx{args.dx}_dy{args.dy}_{args.method}.jpg')
+    if not cv2.imwrite(output, refocused_im):
+        raise IOError(f'Could not write {output}')
+    return {'num_frames': len(frames), 'output': output}
+
+
+def xslits_sequence(dir, args, num_workers):
+    """
+    Creates the panoramas of the given sequence (see produce_panorama_sequence) and saves them in '<out>/<sequence>',
+    or in the video '<out>/<sequence>.avi' if --video is given.
+    :return: the status of the sequence, with the end points of the panoramas which were skipped as illegal
+    """
+    frames, homographies = load_panorama_sequence(dir, args.motion_dir, args.frames_dir, lazy=args.lazy,
+                                                  stride=args.stride, num_workers=num_workers,
+                                                  estimator=args.estimator)
+    sequence = sequence_name(dir)
+    if args.sweep == 'left-right':
+        end_points = [(0, len(frames) - 1, i, i) for i in range(frames[0].shape[1])]
+    else:
+        end_frame = len(frames) - 1 if args.end_frame is None else args.end_frame
+        end_column = frames[0].shape[1] - 1 if args.end_column is None else args.end_column
+        end_points = sweep_end_points(args.start_frame, end_frame, args.start_column, end_column,
+                                      None if args.sweep == 'none' else args.sweep)
+    video_path = None
+    if args.video:
+        os.makedirs(args.out, exist_ok=True)
+        video_path = os.path.join(args.out, f'{sequence}.avi')
+    skipped = render_panoramas(frames, homographies, end_points, sequence, video_path, args.out, num_workers)
+    return {'num_frames': len(frames), 'num_panoramas': len(end_points) - len(skipped),
+            'skipped': [list(points) for points in skipped], 'output': video_path or os.path.join(args.out, sequence)}
+
+
+COMMANDS = {'motion': motion_sequence, 'refocus': refocus_sequence, 'xslits': xslits_sequence}
+
+
+def run_sequence(command, dir, args, num_workers):
+    """
+    Runs the given command on a single sequence. Errors are reported in the status instead of being raised, so one
+    failing sequence doesn't stop the others.
+    :return: the status of the sequence, as reported on the standard output
+    """
+    start = time.time()
+    status = {'command': command, 'sequence': dir}
+    try:
+        status.update(COMMANDS[command](dir.rstrip('/'), args, num_workers))
+        status['status'] = 'ok'
+    except Exception as e:
+        status.update(status='error', error=f'{type(e).__name__}: {e}')
+    status['seconds'] = round(time.time() - start, 3)
+    return status
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m Code.cli',
+                                     description='Runs the refocusing and X-Slits tasks without a GUI.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('sequences', nargs='+', help='directories of frames or video files')
+    common.add_argument('--motion-dir', default='Motion', help='the directory of the motion files')
+    common.add_argument('--frames-dir', default='Frames', help='the directory of the cached frame stacks of videos')
+    common.add_argument('--stride', type=int, default=1, help='use only every stride-th frame of a video')
+    common.add_argument('--jobs', type=int, default=1, help='the number of sequences processed concurrently')
+    common.add_argument('--workers', type=int, default=None,
+                        help='the number of threads used for every sequence (default: the number of cores divided by '
+                             'the number of jobs)')
+    common.add_argument('--estimator', choices=MOTION_ESTIMATORS, default='orb',
+                        help="the motion estimator. 'phase' and 'profile' require translation-only motion, and are "
+                             "faster but less accurate than 'orb' (see MOTION_ESTIMATORS in GUI_helper.py)")
+    common.add_argument('--stats', help='save the statistics of the instrumented stages as JSON in this file')
+    common.add_argument('--trace', help='save the instrumented stages as a Chrome trace in this file')
+    common.add_argument('--trace-memory', action='store_true',
+                        help='also record the net memory retained by every stage, which slows the stages down')
+
+    motion = subparsers.add_parser('motion', parents=[common], help='compute and cache the motion of sequences')
+    motion.add_argument('--translation-only', action='store_true')
+    motion.add_argument('--task', choices=['refocus', 'xslits'], default='refocus',
+                        help="the task the motion is computed for. 'xslits' computes the translation-only motion of "
+                             "the frames ordered from left to right, which is reused by the xslits command")
+
+    refocus_parser = subparsers.add_parser('refocus', parents=[common], help='compute refocused images')
+    refocus_parser.add_argument('--out', default='Results', help='the directory of the refocused images')
+    refocus_parser.add_argument('--dx', type=float, default=0.0, help='the shift between consecutive frames in x')
+    refocus_parser.add_argument('--dy', type=float, default=0.0, help='the shift between consecutive frames in y')
+    refocus_parser.add_argument('--method', choices=['mean', 'median'], default='mean')
+    refocus_parser.add_argument('--ref-frame', type=int, default=None,
+                                help='the reference frame (default: N//2-1, like the refocusing GUI)')
+    refocus_parser.add_argument('--translation-only', action='store_true')
+
+    xslits = subparsers.add_parser('xslits', parents=[common], help='create X-Slits panoramas')
+    xslits.add_argument('--out', default='Results', help='the directory of the panoramas')
+    xslits.add_argument('--start-frame', type=int, default=0)
+    xslits.add_argument('--end-frame', type=int, default=None, help='default: the last frame')
+    xslits.add_argument('--start-column', type=int, default=0)
+    xslits.add_argument('--end-column', type=int, default=None, help='default: the last column')
+    xslits.add_argument('--sweep', choices=['none', 'frames', 'cols', 'left-right'], default='none',
+                        help="'frames' and 'cols' fix the frames or the columns (see produce_panorama_sequence), and "
+                             "'left-right' creates all the panoramas with equal starting and ending columns")
+    xslits.add_argument('--video', action='store_true', help='encode the panoramas into a video instead of images')
+    xslits.add_argument('--lazy', action='store_true', help='decode only the frames used by the panoramas')
+    xslits.set_defaults(translation_only=True)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Runs the command line interface.
+    :return: the exit status - 0 if all the sequences succeeded and 1 otherwise
+    """
+    args = parse_args(argv)
+    num_jobs = max(1, min(args.jobs, len(args.sequences)))
+    num_workers = args.workers or max(1, NUM_WORKERS // num_jobs)
+    succeeded = True
+    if args.stats or args.trace:
+        PROFILER.enable(trace_memory=args.trace_memory)
+    executor = ThreadPoolExecutor(max_workers=num_jobs)
+    try:
+        futures = [executor.submit(run_sequence, args.command, dir, args, num_workers) for dir in args.sequences]
+        for future in as_completed(futures):
+            status = future.result()
+            succeeded &= status['status'] == 'ok'
+            print(json.dumps(status), flush=True)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    if args.stats:
+        PROFILER.save_json(args.stats)
+    if args.trace:
+        PROFILER.save_chrome_trace(args.trace)
+    return 0 if succeeded else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
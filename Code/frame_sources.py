@@ -0,0 +1,333 @@
+from Code.GUI_helper import *
+from collections import OrderedDict
+import re
+import threading
+
+# This file contains different sources of frames which can be used instead of the list of frames returned by
+# load_images. All sources support len(frames), frames[i] and frames[a:b] (which returns a source of the same kind), so
+# the existing panorama and refocusing code can index them exactly like a list of frames.
+
+# The default memory budget of the decoded frames kept by LazyFrames
+FRAME_CACHE_BYTES = 1 << 30
+
+# If True, the GUIs decode frames on demand (LazyFrames) instead of building a FrameStack of the whole sequence
+LAZY_FRAMES = False
+
+
+class FrameStack:
+    """
+    A sequence of frames stored in a single contiguous uint8 array of shape (N, H, W, 3). The array is memory-mapped
+    from a file, which is built once per sequence and reopened instantly on subsequent runs.
+    """
+
+    def __init__(self, array):
+        """
+        :param array: an array (or memory-map) with shape (N, H, W, 3) holding the frames
+        """
+        self.array = array
+
+    @classmethod
+    def open(cls, dir, cache_dir, num_workers=1, progress=None, stride=1):
+        """
+        Opens the frame stack of the images in the given directory. If the stack file of the directory doesn't exist or
+        the images changed since it was built, the images are decoded into a new stack file.
+        :param dir: the directory that holds the images, or a video file (see open_video)
+        :param cache_dir: the directory of the stack files
+        :param num_workers: the number of threads used for decoding the images
+        :param progress: an optional function called as progress(num_decoded, num_images) while building the stack
+        :param stride: for a video, only every stride-th frame is used
+        :return: a FrameStack of the images in the directory
+        """
+        if is_video(dir):
+            return cls.open_video(dir, cache_dir, stride=stride, progress=progress)
+        images_path = list_images(dir)
+        if not images_path:
+            return cls(np.zeros((0, 0, 0, 3), dtype=np.uint8))
+        name = os.path.basename(os.path.normpath(dir))
+        keys_hash = hashlib.sha1('\n'.join(frame_keys(dir)).encode()).hexdigest()[:12]
+        stack_path = os.path.join(cache_dir, f'{name}-{keys_hash}.npy')
+        if not os.path.exists(stack_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            cls.build(images_path, stack_path, num_workers=num_workers, progress=progress)
+            remove_stale_stacks(cache_dir, name, stack_path)
+        return cls(np.load(stack_path, mmap_mode='r'))
+
+    @classmethod
+    def open_video(cls, video_path, cache_dir, stride=1, progress=None):
+        """
+        Opens the frame stack of the given video. The frames are decoded straight from the video into a new stack file
+        if the stack doesn't exist or the video changed since it was built.
+        :param video_path: the path of the video
+        :param cache_dir: the directory of the stack files
+        :param stride: only every stride-th frame of the video is used
+        :param progress: see iterate_video
+        :return: a FrameStack of the frames of the video
+        """
+        name = os.path.basename(video_path)
+        stat = os.stat(video_path)
+        key = f'{name}:{stat.st_size}:{stat.st_mtime_ns}:stride={stride}'
+        stack_path = os.path.join(cache_dir, f'{name}-{hashlib.sha1(key.encode()).hexdigest()[:12]}.npy')
+        if not os.path.exists(stack_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            cls.build_from_video(video_path, stack_path, stride=stride, progress=progress)
+            remove_stale_stacks(cache_dir, name, stack_path)
+        return cls(np.load(stack_path, mmap_mode='r'))
+
+    @staticmethod
+    def build(images_path, stack_path, num_workers=1, progress=None):
+        """
+        Decodes the given images into a new stack file.
+        :param images_path: the paths of the images, in the order of the sequence
+        :param stack_path: the path of the stack file that should be created
+        :param num_workers: the number of threads used for decoding the images
+        :param progress: an optional function called as progress(num_decoded, num_images) after every decoded image
+        """
+        first = read_image(images_path[0])
+        tmp_path = stack_path + '.tmp'
+        stack = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                          shape=(len(images_path),) + first.shape)
+
+        def decode(i):
+            frame = first if i == 0 else read_image(images_path[i])
+            if frame is None or frame.shape != first.shape:
+                raise ValueError(f'All the images in the sequence should have the same size: {images_path[i]}')
+            stack[i] = frame
+
+        try:
+            parallel_map(decode, range(len(images_path)), num_workers=num_workers, progress=progress)
+            stack.flush()
+            del stack
+            os.replace(tmp_path, stack_path)
+        except Exception:
+            del stack
+            os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def build_from_video(video_path, stack_path, stride=1, progress=None):
+        """
+        Decodes the frames of the given video into a new stack file, one frame at a time.
+        :param video_path: the path of the video
+        :param stack_path: the path of the stack file that should be created
+        :param stride: only every stride-th frame of the video is used
+        :param progress: see iterate_video
+        """
+        tmp_path = stack_path + '.tmp'
+        stack = None
+        num_frames = 0
+        try:
+            for frame in iterate_video(video_path, stride=stride, progress=progress):
+                if stack is None:
+                    stack = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                                      shape=(max(video_frame_count(video_path, stride), 1),) +
+                                                      frame.shape)
+                elif num_frames == len(stack):
+                    # the video container underestimated the number of frames
+                    stack = resize_stack_file(stack, tmp_path, 2 * num_frames)
+                stack[num_frames] = frame
+                num_frames += 1
+            if stack is None:
+                raise IOError(f'Could not read any frame from the video {video_path}')
+            if num_frames != len(stack):
+                stack = resize_stack_file(stack, tmp_path, num_frames)
+            stack.flush()
+            del stack
+            os.replace(tmp_path, stack_path)
+        except BaseException:
+            stack = None
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return FrameStack(self.array[i])
+        return self.array[i]
+
+    def __iter__(self):
+        return iter(self.array)
+
+
+def remove_stale_stacks(cache_dir, name, stack_path):
+    """
+    Removes the stack files of older versions of a sequence.
+    :param cache_dir: the directory of the stack files
+    :param name: the name of the sequence
+    :param stack_path: the path of the current stack file of the sequence, which is kept
+    """
+    for file_name in os.listdir(cache_dir):
+        # the hash is matched exactly, so the stacks of other sequences whose names start with the same name are kept
+        if re.fullmatch(re.escape(name) + r'-[0-9a-f]{12}\.npy', file_name) and \
+                os.path.join(cache_dir, file_name) != stack_path:
+            os.remove(os.path.join(cache_dir, file_name))
+
+
+def resize_stack_file(stack, stack_path, num_frames):
+    """
+    Changes the number of frames of a memory-mapped stack file, keeping the frames that fit in the new size.
+    :param stack: the memory-mapped stack
+    :param stack_path: the path of the stack file
+    :param num_frames: the new number of frames
+    :return: the memory-mapped stack with the new size
+    """
+    resized_path = stack_path + '.resized'
+    resized = np.lib.format.open_memmap(resized_path, mode='w+', dtype=stack.dtype,
+                                        shape=(num_frames,) + stack.shape[1:])
+    num_kept = min(num_frames, len(stack))
+    resized[:num_kept] = stack[:num_kept]
+    resized.flush()
+    del stack, resized
+    os.replace(resized_path, stack_path)
+    return np.load(stack_path, mmap_mode='r+')
+
+
+class LRUFrameCache:
+    """
+    A thread safe cache of decoded frames, which keeps the total size of the frames under a given byte budget by
+    evicting the least recently used frames.
+    """
+
+    def __init__(self, max_bytes=FRAME_CACHE_BYTES):
+        """
+        :param max_bytes: the maximal number of bytes of decoded frames kept in the cache
+        """
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, decode=read_image):
+        """
+        Returns the decoded frame of the given path, decoding it if it isn't in the cache.
+        :param path: the path of the image
+        :param decode: the function used for decoding the image
+        :return: the decoded frame
+        """
+        with self.lock:
+            if path in self.frames:
+                self.frames.move_to_end(path)
+                return self.frames[path]
+        frame = decode(path)
+        if frame is None:
+            raise IOError(f'Could not read the image {path}')
+        with self.lock:
+            if path not in self.frames:
+                self.frames[path] = frame
+                self.num_bytes += frame.nbytes
+            while self.num_bytes > self.max_bytes and len(self.frames) > 1:
+                _, evicted = self.frames.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+        return frame
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.num_bytes = 0
+
+
+class LazyFrames:
+    """
+    A sequence of frames which are decoded only when they are accessed, through an LRU cache with a bounded memory
+    budget. Creating a panorama from a part of a long sequence only reads the frames in this part.
+    """
+
+    def __init__(self, images_path, cache=None):
+        """
+        :param images_path: the paths of the images, in the order of the sequence
+        :param cache: an LRUFrameCache. Slices of a LazyFrames share the cache of the original sequence.
+        """
+        self.images_path = images_path
+        self.cache = cache if cache is not None else LRUFrameCache()
+
+    @classmethod
+    def open(cls, dir, max_bytes=FRAME_CACHE_BYTES):
+        """
+        :param dir: the directory that holds the images
+        :param max_bytes: the memory budget of the decoded frames
+        :return: a LazyFrames of the images in the directory
+        """
+        return cls(list_images(dir), LRUFrameCache(max_bytes))
+
+    @property
+    def shape(self):
+        return (len(self),) + self[0].shape if len(self) else (0, 0, 0, 3)
+
+    def __len__(self):
+        return len(self.images_path)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return LazyFrames(self.images_path[i], self.cache)
+        return self.cache.get(self.images_path[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class FramePyramid:
+    """
+    Downscaled copies of the frames of a sequence, used for rendering quick previews. Every level is computed when it
+    is first requested and kept in memory.
+    """
+
+    def __init__(self, frames):
+        """
+        :param frames: the frames of the sequence
+        """
+        self.frames = frames
+        self.levels = {}
+
+    def level(self, factor, num_workers=1, progress=None):
+        """
+        :param factor: the factor by which the frames are downscaled (1 for the original frames)
+        :param num_workers: the number of threads used for downscaling the frames
+        :param progress: see parallel_map
+        :return: a uint8 array with shape (N, H/factor, W/factor, 3) of the downscaled frames
+        """
+        if factor == 1:
+            return self.frames
+        if factor not in self.levels:
+            height, width = self.frames[0].shape[:2]
+            size = (max(1, width // factor), max(1, height // factor))
+            level = np.empty((len(self.frames), size[1], size[0]) + self.frames[0].shape[2:], dtype=np.uint8)
+
+            def downscale(i):
+                level[i] = cv2.resize(self.frames[i], size, interpolation=cv2.INTER_AREA)
+
+            parallel_map(downscale, range(len(self.frames)), num_workers=num_workers, progress=progress)
+            self.levels[factor] = level
+        return self.levels[factor]
+
+
+def sequence_name(dir):
+    """
+    :return: the name of the sequence in the given directory or video file
+    """
+    name = os.path.basename(os.path.normpath(dir))
+    return os.path.splitext(name)[0] if is_video(dir) else name
+
+
+def open_frames(dir, cache_dir, lazy=False, max_bytes=FRAME_CACHE_BYTES, num_workers=1, progress=None, stride=1):
+    """
+    Opens the frames of the images in the given directory
+    :param dir: the directory that holds the images, or a video file. The frames of a video are always decoded into a
+            FrameStack (see FrameStack.open_video).
+    :param cache_dir: the directory of the stack files (see FrameStack.open)
+    :param lazy: if True, a LazyFrames is returned. Otherwise, a FrameStack is returned.
+    :param max_bytes: the memory budget of the decoded frames of a LazyFrames
+    :param num_workers: the number of threads used for decoding the images of a FrameStack
+    :param progress: an optional function called as progress(num_decoded, num_images) while building a FrameStack
+    :param stride: for a video, only every stride-th frame is used
+    :return: the frames of the sequence
+    """
+    if lazy and not is_video(dir):
+        return LazyFrames.open(dir, max_bytes=max_bytes)
+    return FrameStack.open(dir, cache_dir, num_workers=num_workers, progress=progress, stride=stride)
@@ -0,0 +1,169 @@
+from collections import deque
+from contextlib import contextmanager, nullcontext
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+
+# This file contains a lightweight instrumentation layer. The hot paths of the tasks (decoding, feature detection,
+# matching, RANSAC, warping, the median, panoramas, displaying images...) are wrapped in named spans, which record their
+# wall time, their number of calls and optionally the net memory they retained. The spans can be summarized, exported
+# to JSON or to the Chrome trace format (open it in chrome://tracing or https://ui.perfetto.dev), and shown in the GUIs.
+
+# If True, the spans are recorded from the start and the GUIs show a 'Stats' button which opens a panel of the
+# statistics of the spans. Recording can also be enabled later with PROFILER.enable().
+PROFILING = False
+
+# The maximal number of spans kept for the Chrome trace. Older spans are dropped, so a long GUI session doesn't grow
+# without bound. The statistics of the spans (see Profiler.summary) include all the spans.
+MAX_TRACE_EVENTS = 100000
+
+
+class Profiler:
+    """
+    Records named spans and counters. Spans may be recorded from any thread. When the profiler is disabled, a span
+    costs a single attribute check.
+    """
+
+    def __init__(self, enabled=PROFILING):
+        self.enabled = enabled
+        self.trace_memory = False
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.events = deque(maxlen=MAX_TRACE_EVENTS)
+        self.stats = {}
+
+    def enable(self, trace_memory=False):
+        """
+        Starts recording spans.
+        :param trace_memory: if True, the net bytes retained by every span are traced with tracemalloc (see
+                record_span), which slows down allocations and so inflates the recorded durations
+        """
+        self.enabled = True
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.trace_memory = False
+
+    def reset(self):
+        """
+        Removes all the recorded spans and counters.
+        """
+        with self.lock:
+            self.origin = time.perf_counter()
+            self.events = deque(maxlen=MAX_TRACE_EVENTS)
+            self.stats = {}
+
+    def span(self, name, **args):
+        """
+        :param name: the name of the span, e.g. 'ransac'
+        :param args: optional values attached to the span in the trace
+        :return: a context manager which records the span
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self.record_span(name, args)
+
+    @contextmanager
+    def record_span(self, name, args):
+        """
+        Records a span. If memory is traced, the net retained bytes of the span are the change of the traced memory of
+        the whole process between its start and its end: temporaries freed within the span are not counted, memory
+        freed by the span counts as negative, and spans running at the same time in other threads are included.
+        """
+        allocated = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            if self.trace_memory:
+                allocated = tracemalloc.get_traced_memory()[0] - allocated
+            with self.lock:
+                stats = self.stats.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'net_bytes': 0})
+                stats['calls'] += 1
+                stats['seconds'] += duration
+                stats['max_seconds'] = max(stats['max_seconds'], duration)
+                stats['net_bytes'] += allocated
+                self.events.append((name, start - self.origin, duration, threading.get_ident(), args))
+
+    def count(self, name, **values):
+        """
+        Adds the given values to the counters of the given name, e.g. count('ransac', iterations=100, inliers=40).
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self.stats.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'net_bytes': 0})
+            for key, value in values.items():
+                stats[key] = stats.get(key, 0) + value
+
+    def summary(self):
+        """
+        :return: a dictionary with the statistics of every span - the number of calls, the total and maximal wall time
+                in seconds, the net retained bytes (see record_span) and the counters added by count
+        """
+        with self.lock:
+            return {name: dict(stats) for name, stats in self.stats.items()}
+
+    def format_summary(self):
+        """
+        :return: the summary as a text table, ordered by the total time of the spans
+        """
+        lines = [f"{'span':<24}{'calls':>8}{'total s':>10}{'max s':>9}{'net MB':>8}  counters"]
+        for name, stats in sorted(self.summary().items(), key=lambda item: -item[1]['seconds']):
+            counters = ' '.join(f'{key}={value}' for key, value in stats.items()
+                                if key not in ('calls', 'seconds', 'max_seconds', 'net_bytes'))
+            lines.append(f"{name:<24}{stats['calls']:>8}{stats['seconds']:>10.3f}{stats['max_seconds']:>9.3f}"
+                         f"{stats['net_bytes'] / 2 ** 20:>8.1f}  {counters}")
+        return '\n'.join(lines)
+
+    def save_json(self, path):
+        """
+        Saves the summary (see summary) as JSON in the given path.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+    def save_chrome_trace(self, path):
+        """
+        Saves all the recorded spans in the Chrome trace format in the given path.
+        """
+        with self.lock:
+            events = list(self.events)
+        trace = [{'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6, 'pid': os.getpid(), 'tid': tid,
+                  'args': args} for name, start, duration, tid, args in events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+# The profiler used by all the modules
+PROFILER = Profiler()
+
+
+def span(name, **args):
+    """
+    :return: a context manager which records a span of the given name in PROFILER (see Profiler.span)
+    """
+    return PROFILER.span(name, **args)
+
+
+def traced(name):
+    """
+    A decorator which records every call of the decorated function as a span of the given name in PROFILER.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with PROFILER.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
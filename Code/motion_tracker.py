@@ -0,0 +1,156 @@
+from Code.GUI_helper import *
+import time
+
+
+# This file contains an online motion tracker, which estimates the motion of a sequence one frame at a time while the
+# sequence is still being captured, so panoramas can be rendered from the part of the sequence that already arrived.
+
+
+class MotionTracker:
+    """
+    Estimates the homography between every new frame and the previous one as the frames arrive. Only the features of
+    the last frame are kept. The new homographies are added to the motion file of the sequence (see
+    load_or_compute_motion) next to the pairs which are already in it, and the pairs of frames which are already in the
+    motion file are not computed again. The accumulated homographies of all the frames with respect to the first frame
+    are maintained as well.
+    """
+
+    def __init__(self, cache_dir, name, translation_only=False, seed=None, save_every=100):
+        """
+        :param cache_dir: the directory of the motion files
+        :param name: the name of the sequence
+        :param translation_only: see compute_homographies
+        :param seed: see compute_homographies. The tracker computes the same homographies as compute_homographies with
+                the same seed.
+        :param save_every: the motion file is saved after every save_every new homographies (and by save). Every save
+                rewrites the whole motion file, so saving after every frame takes time quadratic in the length of the
+                capture.
+        """
+        self.name = name
+        self.translation_only = translation_only
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.save_every = save_every
+        self.cache_path = motion_cache_path(cache_dir, name, translation_only)
+        self.cached = load_motion(self.cache_path, translation_only)
+        self.session = time.time_ns()
+        self.keys = []
+        self.last_frame = None
+        self.last_features = None
+        self.num_unsaved = 0
+        self.successive = np.zeros((3, 3, 16))
+        self.accumulated = np.zeros((3, 3, 16))
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def homographies(self):
+        """
+        :return: an array of shape 3x3x(N-1) of the homographies between every two consecutive frames so far, in the
+                format returned by compute_homographies
+        """
+        return self.successive[:, :, :max(len(self) - 1, 0)]
+
+    @property
+    def accumulated_homographies(self):
+        """
+        :return: an array of shape 3x3xN. accumulated_homographies[:,:,i] is the homography from frame i to the first
+                frame, as returned by accumulate_homographies with the reference frame 0.
+        """
+        return self.accumulated[:, :, :len(self)]
+
+    def add(self, frame, key=None):
+        """
+        Adds the next frame of the sequence.
+        :param frame: the new frame
+        :param key: the key of the frame (see frame_keys). Frames without a key get a key that is unique to this
+                tracker, so their motion is never taken from the motion file (nor saved in it).
+        :return: the 3x3 homography between the previous frame and the new frame (the identity for the first frame)
+        """
+        i = len(self)
+        key = f'{self.name}@{i}:{self.session}' if key is None else key
+        if i + 1 > self.accumulated.shape[2]:
+            self.successive = np.concatenate([self.successive, np.zeros_like(self.successive)], axis=2)
+            self.accumulated = np.concatenate([self.accumulated, np.zeros_like(self.accumulated)], axis=2)
+
+        features = None
+        if i == 0:
+            H = np.eye(3)
+            self.accumulated[:, :, 0] = H
+        else:
+            pair = (self.keys[-1], key)
+            if pair in self.cached:
+                H = self.cached[pair]
+            else:
+                features = detect_features(frame)
+                if self.last_features is None:
+                    self.last_features = detect_features(self.last_frame)
+                rng = np.random.default_rng(np.random.SeedSequence(self.seed_sequence.entropy, spawn_key=(i - 1,)))
+                H = match_features(*features, *self.last_features, translation_only=self.translation_only, rng=rng)
+                self.num_unsaved += 1
+            self.successive[:, :, i - 1] = H
+            self.accumulated[:, :, i] = np.dot(self.accumulated[:, :, i - 1], np.linalg.inv(H))
+            self.accumulated[:, :, i] /= self.accumulated[2, 2, i]
+
+        # the features of the new frame are detected only when they are needed for matching the next frame
+        self.last_frame = frame
+        self.last_features = features
+        self.keys.append(key)
+        if self.num_unsaved >= self.save_every:
+            self.save()
+        return H
+
+    def add_frames(self, frames, keys=None, progress=None):
+        """
+        Adds the given frames, one at a time. The frames may be a generator, such as iterate_video.
+        :param frames: the new frames
+        :param keys: the keys of the frames (see add)
+        :param progress: an optional function called as progress(num_frames) after every frame
+        """
+        for j, frame in enumerate(frames):
+            self.add(frame, None if keys is None else keys[j])
+            if progress:
+                progress(len(self))
+
+    def update_from_directory(self, dir):
+        """
+        Adds the images of the given directory that were not added yet, so a directory in which a sequence is being
+        captured can be followed. The images are expected to arrive in alphanumeric order. Adding stops at the first
+        image that can't be read (e.g. an image that is still being written), which is added by a later call.
+        :param dir: the directory that holds the images
+        :return: the number of frames that were added
+        """
+        num_frames = len(self)
+        for im_path, key in zip(list_images(dir)[num_frames:], frame_keys(dir)[num_frames:]):
+            frame = read_image(im_path)
+            if frame is None:
+                break
+            self.add(frame, key)
+        return len(self) - num_frames
+
+    def accumulate(self, ref_frame):
+        """
+        :return: an array of shape 3x3xN of the homographies from every frame to the given reference frame, as returned
+                by accumulate_homographies
+        """
+        accumulated = np.einsum('ij,jkn->ikn', np.linalg.inv(self.accumulated[:, :, ref_frame]),
+                                self.accumulated_homographies)
+        return accumulated / accumulated[2, 2, :]
+
+    def save(self):
+        """
+        Saves the motion computed so far in the motion file of the sequence, together with the pairs that were already
+        in it. The pairs of frames without a key are not saved.
+        """
+        pairs = {(key1, key2): self.successive[:, :, i] for i, (key1, key2) in enumerate(zip(self.keys, self.keys[1:]))
+                 if not (self.is_session_key(key1) or self.is_session_key(key2))}
+        if any(pair not in self.cached for pair in pairs):
+            self.cached.update(pairs)
+            save_motion_pairs(self.cache_path, self.cached, self.translation_only)
+        self.num_unsaved = 0
+
+    def is_session_key(self, key):
+        """
+        :return: True if the given key was made up by this tracker for a frame without a key (see add)
+        """
+        return key.endswith(f':{self.session}') and key.startswith(f'{self.name}@')
@@ -0,0 +1,155 @@
+from Code.GUI_helper import *
+
+
+# This file contains a streaming refocusing engine. Instead of warping all the frames into a single 4D array and then
+# computing the mean or median over it, the frames are warped and shifted one at a time, so the memory used for
+# refocusing doesn't grow with the number of frames in the sequence.
+
+# The maximal size of an aligned stack (N, H, W, 3) that is kept in memory by the refocusing GUI. Longer sequences are
+# refocused with the streaming engine.
+ALIGNED_STACK_BYTES = 2 << 30
+
+# The memory budget of the row tiles used for computing the streaming median
+MEDIAN_TILE_BYTES = 256 << 20
+
+@traced('warp')
+def warp_frame(frame, h_inv, size, dst=None):
+    """
+    Warps the given frame, like cv2.warpPerspective(frame, h_inv, size, dst=dst). Pure translations are dispatched to
+    cheaper paths with the same result: an integer translation is a copy of a block of the frame, and a subpixel
+    translation is warped by cv2.warpAffine.
+    :param frame: the frame that should be warped
+    :param h_inv: the 3x3 homography from the reference frame to the given frame (as passed to cv2.warpPerspective)
+    :param size: the (width, height) of the warped frame
+    :param dst: an optional uint8 array with the shape of the warped frame, in which the warped frame is written
+    :return: the warped frame
+    """
+    h_inv = h_inv / h_inv[2, 2]
+    if np.any(h_inv[:2, :2] != np.eye(2)) or np.any(h_inv[2, :2] != 0):
+        return cv2.warpPerspective(frame, h_inv, size, dst=dst)
+    tx, ty = h_inv[0, 2], h_inv[1, 2]
+    # cv2 interpolates at 1/32 of a pixel, so a translation closer than that to an integer is an integer translation
+    if abs(tx - round(tx)) > 1e-3 or abs(ty - round(ty)) > 1e-3:
+        return cv2.warpAffine(frame, h_inv[:2], size, dst=dst)
+    return shift_frame(frame, int(round(tx)), int(round(ty)), size, dst)
+
+
+def shift_frame(frame, dx, dy, size, dst=None):
+    """
+    Translates the given frame by an integer number of pixels. The pixels outside the frame are black.
+    :param frame: the frame that should be translated
+    :param dx: the number of pixels the frame is translated by in the x direction
+    :param dy: the number of pixels the frame is translated by in the y direction
+    :param size: the (width, height) of the translated frame
+    :param dst: an optional array in which the translated frame is written
+    :return: the translated frame
+    """
+    if dst is None:
+        dst = np.zeros((size[1], size[0]) + frame.shape[2:], dtype=frame.dtype)
+    else:
+        dst[...] = 0
+    x_start, x_end = max(0, -dx), min(frame.shape[1], size[0] - dx)
+    y_start, y_end = max(0, -dy), min(frame.shape[0], size[1] - dy)
+    if x_start < x_end and y_start < y_end:
+        dst[y_start + dy:y_end + dy, x_start + dx:x_end + dx] = frame[y_start:y_end, x_start:x_end]
+    return dst
+
+
+def warp_frames(frames, h_invs, shape, out=None, num_workers=1, progress=None):
+    """
+    Warps all the given frames, in parallel, into a single frame-major array.
+    :param frames: the frames that should be warped
+    :param h_invs: the 3x3 homographies from the reference frame to every frame (see warp_frame)
+    :param shape: the shape of a warped frame
+    :param out: an optional preallocated uint8 array of shape (N,) + shape in which the warped frames are written
+    :param num_workers: the number of threads used for warping the frames
+    :param progress: an optional function called as progress(num_done, num_frames) after every frame
+    :return: the array of the warped frames
+    """
+    out = np.empty((len(frames),) + tuple(shape), dtype=np.uint8) if out is None else out
+    parallel_map(lambda i: warp_frame(frames[i], h_invs[i], (shape[1], shape[0]), dst=out[i]), range(len(frames)),
+                 num_workers=num_workers, progress=progress)
+    return out
+
+
+def warp_rows(frame, h_inv, shape, row_start, row_end):
+    """
+    Warps the given frame to the reference frame, computing only the given range of rows of the warped frame
+    :param frame: the frame that should be warped
+    :param h_inv: the 3x3 homography from the reference frame to the given frame
+    :param shape: the shape of the warped frame
+    :param row_start: the first row of the warped frame that should be computed
+    :param row_end: the row after the last row of the warped frame that should be computed
+    :return: the rows row_start:row_end of the warped frame
+    """
+    offset = np.array([[1, 0, 0], [0, 1, -row_start], [0, 0, 1]], dtype=np.float64)
+    return warp_frame(frame, offset @ h_inv, (shape[1], row_end - row_start))
+
+
+def shift_homography(h_inv, dx=0, dy=0):
+    """
+    Composes a translation of the warped frame with the given homography, so a frame can be aligned and shifted by a
+    single warp.
+    :param h_inv: the 3x3 homography from the reference frame to the frame (as passed to cv2.warpPerspective)
+    :param dx: the number of pixels that the warped frame should be translated by in the x direction
+    :param dy: the number of pixels that the warped frame should be translated by in the y direction
+    :return: the 3x3 homography which aligns the frame to the reference frame and shifts it by dx and dy
+    """
+    translation = np.array([[1, 0, dx], [0, 1, dy], [0, 0, 1]], dtype=np.float64)
+    return translation @ h_inv
+
+
+@traced('refocus')
+def refocus(frames, homographies, shape, dx=0, dy=0, method='mean', max_bytes=MEDIAN_TILE_BYTES, progress=None,
+            num_workers=1):
+    """
+    Computes a refocused image by aligning every frame to the reference frame, shifting frame i by (dx*(i+1), dy*(i+1))
+    and combining the shifted frames. Aligning and shifting a frame is done by a single bilinear warp. The frames are
+    processed one at a time: the mean is accumulated as a running sum and the median is computed over tiles of rows
+    whose size is bounded by max_bytes.
+    :param frames: the frames of the sequence
+    :param homographies: a 3x3xN array. homographies[:,:,i] is the homography from frame i to the reference frame.
+    :param shape: the shape of the refocused image
+    :param dx: the shift between consecutive frames in the x direction
+    :param dy: the shift between consecutive frames in the y direction
+    :param method: 'mean' or 'median'
+    :param max_bytes: the memory budget of a tile of rows of all frames, used for computing the median
+    :param progress: an optional function called as progress(num_done, num_total) after every frame (for the mean) or
+            tile of rows (for the median)
+    :param num_workers: the number of threads used for warping the frames
+    :return: the refocused uint8 image
+    """
+    num_frames = len(frames)
+    h_invs = [np.linalg.inv(homographies[:, :, i]) for i in range(num_frames)]
+
+    def render(i, row_start, row_end):
+        return warp_rows(frames[i], shift_homography(h_invs[i], dx * (i + 1), dy * (i + 1)), shape, row_start,
+                         row_end)
+
+    if method == 'mean':
+        total = np.zeros(shape, dtype=np.float32)
+        warped_frames = parallel_imap(lambda i: render(i, 0, shape[0]), range(num_frames), num_workers=num_workers)
+        for i, warped in enumerate(warped_frames):
+            total += warped
+            if progress:
+                progress(i + 1, num_frames)
+        return (total / num_frames).astype(np.uint8)
+
+    if method != 'median':
+        raise ValueError(f"Unknown refocusing method '{method}', should be 'mean' or 'median'")
+    row_bytes = num_frames * int(np.prod(shape[1:]))
+    tile_rows = int(np.clip(max_bytes // row_bytes, 1, shape[0]))
+    tile = np.empty((num_frames, tile_rows) + tuple(shape[1:]), dtype=np.uint8)
+    refocused_im = np.empty(shape, dtype=np.uint8)
+
+    def fill_tile(i, row_start, row_end):
+        tile[i, :row_end - row_start] = render(i, row_start, row_end)
+
+    for row_start in range(0, shape[0], tile_rows):
+        row_end = min(shape[0], row_start + tile_rows)
+        parallel_map(lambda i: fill_tile(i, row_start, row_end), range(num_frames), num_workers=num_workers)
+        with span('median'):
+            refocused_im[row_start:row_end] = np.median(tile[:, :row_end - row_start], axis=0)
+        if progress:
+            progress(row_end, shape[0])
+    return refocused_im
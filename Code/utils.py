@@ -1,4 +1,6 @@
 from Code.GUI_helper import *
+from Code.frame_sources import *
+from Code.xslits_engine import *
 import matplotlib.pyplot as plt
 
 
@@ -6,55 +8,112 @@ import matplotlib.pyplot as plt
 # sequence into frames, creating a new video from the resulting frames and creating multiple panoramas.
 
 
-def video2frames(file_name):
+def video2frames(file_name, stride=1, display=False):
     """
-    This function reads the given video and breaks it down into frames. Moreover, this function produces a 10x naive
-    fast-forward video, by sampling every 10th frames uniformly
-    :param file_name: The name of the video that should be produced.
+    This function reads the given video and breaks it down into frames. Frame sources can also read a video directly
+    (see FrameStack.open_video), without breaking it into frames first.
+    :param file_name: The name of the video that should be broken into frames.
+    :param stride: only every stride-th frame of the video is saved
+    :param display: if True, every frame is displayed while it is saved (press Q to stop). Otherwise no window is
+    opened.
     """
-    # Create a VideoCapture object and read from input file
-    cap = cv2.VideoCapture('../Videos/' + file_name + '.mp4')
     os.system('mkdir ../Data/' + file_name)
-
-    # Check if camera opened successfully
-    if (cap.isOpened() == False):
-        print("Error opening video stream or file")
-
-    # Read until video is completed
-    i = 1
-    while (cap.isOpened()):
-        # Capture frame-by-frame
-        ret, frame = cap.read()
-        if ret:
-            # Display the resulting frame
+    for i, frame in enumerate(iterate_video('../Videos/' + file_name + '.mp4', stride=stride), 1):
+        cv2.imwrite('../Data/' + file_name + '/' + file_name + str(i) + '.jpg', frame)
+        if display:
             cv2.imshow('Frame', frame)
-            cv2.imwrite('../Data/' + file_name + '/' + file_name + str(i) + '.jpg', frame)
 
             # Press Q on keyboard to  exit
-            if cv2.waitKey(10) & 0xFF == ord('q'):
+            if cv2.waitKey(1) & 0xFF == ord('q'):
                 break
-        else:
-            break
-        i += 1
-
-    cap.release()
-    # Closes all the frames
-    cv2.destroyAllWindows()
+    if display:
+        cv2.destroyAllWindows()
 
 
-def frames2video(dir):
+def frames2video(dir, video_path=None):
     """
     Creates a new output video from the frames in the specified dir.
+    :param video_path: the path of the video. Defaults to '../Results/<sequence>.avi'.
     """
-    frames = load_images(dir)
-    im_shape = frames[-1].shape
-    out = cv2.VideoWriter('../Results/train-in-snow-reversed.avi', cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'), 30,
-                          (im_shape[1], im_shape[0]))
+    if video_path is None:
+        video_path = f'../Results/{os.path.basename(os.path.normpath(dir))}.avi'
+    frames = open_frames(dir, '../Frames', lazy=True)
+    with VideoSink(video_path) as sink:
+        for frame in frames:
+            sink.write(frame)
 
-    for frame in frames:
-        out.write(frame)
 
-    out.release()
+class VideoSink:
+    """
+    Encodes images, such as the views of a panorama sweep, straight into a video file. Images whose size differs from
+    the size of the video are centered in it: they are padded with black where they are smaller than the video and
+    cropped where they are larger.
+    """
+
+    def __init__(self, video_path, size=None, fps=30, fourcc='MJPG'):
+        """
+        :param video_path: the path of the video
+        :param size: the (width, height) of the video. If None, the size of the first image (rounded down to even
+                numbers) is used.
+        :param fps: the frame rate of the video
+        :param fourcc: the four character code of the codec
+        """
+        self.video_path = video_path
+        self.size = size
+        self.fps = fps
+        self.fourcc = fourcc
+        self.writer = None
+        self.canvas = None
+
+    @traced('encode')
+    def write(self, im, end_points=None):
+        """
+        Appends the given BGR image to the video. The signature matches the writers of PanoramaRenderer.render_all.
+        """
+        if self.writer is None:
+            if self.size is None:
+                # many codecs only support even sizes
+                self.size = (im.shape[1] // 2 * 2, im.shape[0] // 2 * 2)
+            self.writer = cv2.VideoWriter(self.video_path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, self.size)
+            if not self.writer.isOpened():
+                raise IOError(f'Could not open the video {self.video_path} for writing')
+            self.canvas = np.zeros((self.size[1], self.size[0], 3), dtype=np.uint8)
+        self.writer.write(self.fit(im))
+
+    def fit(self, im):
+        """
+        :return: the given image centered in an image of the size of the video
+        """
+        width, height = self.size
+        if im.shape[:2] == (height, width):
+            return np.ascontiguousarray(im)
+        src_y, dst_y, fit_height = center_offsets(im.shape[0], height)
+        src_x, dst_x, fit_width = center_offsets(im.shape[1], width)
+        self.canvas[:] = 0
+        self.canvas[dst_y: dst_y + fit_height, dst_x: dst_x + fit_width] = \
+            im[src_y: src_y + fit_height, src_x: src_x + fit_width]
+        return self.canvas
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def center_offsets(src_length, dst_length):
+    """
+    Computes how a segment of the given length is centered in a segment of another length.
+    :return: the offset in the source segment, the offset in the destination segment and the length that is copied
+    """
+    if src_length > dst_length:
+        return (src_length - dst_length) // 2, 0, dst_length
+    return 0, (dst_length - src_length) // 2, src_length
 
 
 def reverse_video(dir):
@@ -73,113 +132,6 @@ def reverse_video(dir):
         i -= 1
 
 
-def create_panorama_small_start(start_frame, end_frame, start_column, end_column, frames, homographies):
-    """
-    Creates a new panorama image in the case where the starting column is smaller than the ending column
-    :param start_frame: the first frame to use for the panorama
-    :param end_frame: the last frame to use for the panorama
-    :param start_column: the first column to use in the panorama
-    :param end_column: the last column to use in the panorama
-    :param frames: the loaded frames that should be used for creating the panorama
-    :param homographies: the homographies between every consecutive frames in the sequence
-    :return: the new panorama image
-    """
-    im_shape = frames[0].shape
-    if start_frame == end_frame:
-        return frames[start_frame][:, start_column:end_column, :]
-    col_range = end_column - start_column
-    total_motion = int(np.sum(np.round(homographies[0, 2, start_frame:end_frame])))
-    first_motion = int(round(homographies[0, 2, start_frame]))
-    num_frames = end_frame - start_frame + 1
-    start_pos = calculate_added_motion(start_column + first_motion, end_column, num_frames)
-    panorama_width = total_motion + col_range
-    panorama_im = np.zeros((im_shape[0], panorama_width, im_shape[2])).astype(np.uint8)
-    panorama_col = 0
-
-    if start_column == end_column:
-        for i in range(num_frames - 1):
-            print(i)
-            motion = int(round(homographies[0, 2, start_frame + i]))
-            if start_column + motion < im_shape[1]:
-                panorama_im[:, panorama_col: panorama_col + motion, :] = \
-                    frames[start_frame + i][:, start_column: start_column + motion, :]
-            else:
-                print('in else')
-                panorama_im[:, panorama_col: panorama_col + motion, :] = \
-                    frames[start_frame + i][:, im_shape[1] - motion:, :]
-            panorama_col += motion
-        return panorama_im
-
-    if end_column - start_column < first_motion and end_column != start_column:
-        panorama_im[:, : end_column - start_column, :] = frames[start_frame][:, start_column: end_column, :]
-        panorama_col += end_column - start_column
-        panorama_im[:, panorama_col:, :] = create_panorama_small_start(start_frame, end_frame, start_column,
-                                                                       start_column, frames, homographies)
-        return panorama_im
-
-    panorama_im[:, : start_pos[1] - start_pos[0] + first_motion, :] = \
-        frames[start_frame][:, start_pos[0] - first_motion: start_pos[1], :]
-    panorama_col += start_pos[1] - start_pos[0] + first_motion
-
-    for i in range(1, num_frames):
-        # print(i)
-        motion = int(round(homographies[0, 2, start_frame + i - 1]))
-        if start_pos[i + 1] + motion <= im_shape[1]:
-            panorama_im[:, panorama_col: panorama_col + start_pos[i + 1] - start_pos[i] + motion, :] = \
-                frames[start_frame + i][:, start_pos[i]: start_pos[i + 1] + motion, :]
-        else:
-            panorama_im[:, panorama_col: panorama_col + start_pos[i + 1] - start_pos[i] + motion, :] = \
-                frames[start_frame + i][:, start_pos[i] - motion: start_pos[i + 1], :]
-        panorama_col += start_pos[i + 1] - start_pos[i] + motion
-    return panorama_im
-
-
-def create_panorama_big_start(start_frame, end_frame, start_column, end_column, frames, homographies):
-    """
-    Creates a new panorama image in the case where the starting column is bigger than the ending column
-    :param start_frame: the first frame to use for the panorama
-    :param end_frame: the last frame to use for the panorama
-    :param start_column: the first column to use in the panorama
-    :param end_column: the last column to use in the panorama
-    :param frames: the loaded frames that should be used for creating the panorama
-    :param homographies: the homographies between every consecutive frames in the sequence
-    :return: the new panorama image
-    """
-    im_shape = frames[0].shape
-    if start_frame == end_frame:
-        return frames[start_frame][:, end_column: start_column + 1, :]
-    total_motion = int(np.sum(np.round(homographies[0, 2, start_frame:end_frame])))
-    num_frames = end_frame - start_frame + 1
-    num_cols = start_column - end_column + 1
-    first_motion = int(round(homographies[0, 2, start_frame]))
-    cur_start = start_column - first_motion
-    panorama_width = total_motion
-    if panorama_width <= 0:
-        raise Exception('illegal panorama')
-    panorama_im = np.zeros((im_shape[0], panorama_width, im_shape[2])).astype(np.uint8)
-    panorama_col = 0
-    for i in range(end_frame - start_frame - 1):
-        added_motion = (num_cols - first_motion) // (num_frames - 2)
-        next_motion = int(round(homographies[0, 2, start_frame + i + 1]))
-        if i < ((num_cols - first_motion) % (num_frames - 2)):
-            added_motion += 1
-        cur_end = cur_start + next_motion - added_motion
-        if cur_end < cur_start:
-            cur_start, cur_end = cur_end, cur_start
-        slit_width = cur_end - cur_start
-        if cur_end > start_column:
-            cur_end = start_column
-            cur_start = cur_end - slit_width
-        if cur_start < end_column:
-            cur_start = end_column
-            cur_end = cur_start + slit_width
-        panorama_im[:, panorama_col: panorama_col + slit_width, :] = frames[start_frame + i][:, cur_start:cur_end, :]
-        panorama_col += slit_width
-        cur_start -= added_motion
-    panorama_im = np.delete(panorama_im, np.where((panorama_im == 0).all(0)), axis=1)
-    return panorama_im
-
-
 def create_panorama(start_frame, end_frame, start_column, end_column, frames, homographies):
     """
     Creates a new panorama image defined by the given end points
@@ -191,18 +143,17 @@ def create_panorama(start_frame, end_frame, start_column, end_column, frames, ho
     :param homographies: the homographies between every consecutive frames in the sequence
     :return: the new panorama image
     """
-    if start_column <= end_column:
-        panorama_im = create_panorama_small_start(start_frame, end_frame, start_column, end_column, frames,
-                                                  homographies)
-    else:
-        panorama_im = create_panorama_big_start(start_frame, end_frame, start_column, end_column, frames, homographies)
-    return panorama_im
+    panorama_slice = PanoramaSlice.from_end_points(homographies, frames[0].shape[1], start_frame, end_frame,
+                                                   start_column, end_column)
+    return panorama_slice.gather(frames)
 
 
-def produce_panorama_sequence(dir, start_frame, end_frame, start_column, end_column, fix_param=None):
+def produce_panorama_sequence(dir, start_frame, end_frame, start_column, end_column, fix_param=None, lazy=False,
+                              video_path=None, stride=1, results_dir='../Results', motion_dir='../Motion',
+                              frames_dir='../Frames', num_workers=NUM_WORKERS, estimator='orb'):
     """
     Produces and saves a sequence of panoramas defined by the given parameters.
-    :param dir: the directory of the frames that should be used for the panorama
+    :param dir: the directory of the frames that should be used for the panorama, or a video file
     :param start_frame: the first frame to use for the panorama
     :param end_frame: the last frame to use for the panorama
     :param start_column: the first column to use in the panorama
@@ -212,86 +163,140 @@ def produce_panorama_sequence(dir, start_frame, end_frame, start_column, end_col
     column to the given end column. If the given value is 'cols' then the produced panoramas will be all possible
     panoramas with the fixed columns and frames ranging from the given start and end frames. If not specified the
     function will create a single panorama image from the defined end points.
+    :param lazy: if True, the frames are decoded on demand, so only the frames used by the panoramas are read (once the
+    motion of the sequence is cached).
+    :param video_path: if given, the panoramas are encoded into a video with this path (see VideoSink) instead of being
+    saved as separate images.
+    :param stride: if dir is a video, only every stride-th frame of the video is used
+    :param results_dir: the panoramas are saved in '<results_dir>/<sequence>'
+    :param motion_dir: the directory of the motion files
+    :param frames_dir: the directory of the cached frame stacks
+    :param num_workers: the number of threads used for computing the motion and rendering the panoramas
+    :param estimator: the motion estimator (see MOTION_ESTIMATORS)
+    :return: the number of panoramas that were produced
     """
-    sequence = dir.split('/')[-1]
-    os.system(f'mkdir ../Results/{sequence}')
+    sequence = sequence_name(dir)
+    frames, homographies = load_panorama_sequence(dir, motion_dir, frames_dir, lazy=lazy, stride=stride,
+                                                  num_workers=num_workers, estimator=estimator)
+    end_points = sweep_end_points(start_frame, end_frame, start_column, end_column, fix_param)
+    skipped = render_panoramas(frames, homographies, end_points, sequence, video_path, results_dir, num_workers)
+    return len(end_points) - len(skipped)
 
-    # load the frames:
-    frames = load_images(dir)
-    file_name = dir.split('/')[-1]
-    num_frames = len(frames)
 
-    # compute all homographies:
-    try:
-        homographies = np.genfromtxt('../Motion/' + file_name + '.csv', delimiter=',').reshape((3, 3, num_frames - 1))
-    except IOError:
-        homographies = compute_homographies(frames, translation_only=True)
-        csv_data = homographies.reshape((9, num_frames - 1))
-        np.savetxt('../Motion/' + sequence + '.csv', csv_data, delimiter=',')
+def load_panorama_sequence(dir, motion_dir, frames_dir, lazy=False, stride=1, num_workers=NUM_WORKERS,
+                           estimator='orb'):
+    """
+    Loads the frames of a sequence for creating panoramas, ordered from left to right, and their motion.
+    :param dir: the directory of the frames, or a video file
+    :param motion_dir: the directory of the motion files
+    :param frames_dir: the directory of the cached frame stacks
+    :param lazy: if True, the frames are decoded on demand (see open_frames)
+    :param stride: if dir is a video, only every stride-th frame of the video is used
+    :param num_workers: the number of threads used for loading the frames and computing the motion
+    :param estimator: the motion estimator (see MOTION_ESTIMATORS)
+    :return: the frames and the homographies between every two consecutive frames
+    """
+    os.makedirs(motion_dir, exist_ok=True)
+    os.makedirs(frames_dir, exist_ok=True)
+    frames = open_frames(dir, frames_dir, lazy=lazy, num_workers=num_workers, stride=stride)
+    frames, keys = validate_motion_direction(frames, frame_keys(dir, stride, len(frames)))
+    homographies = load_or_compute_motion(frames, keys, motion_dir, sequence_name(dir), translation_only=True,
+                                          num_workers=num_workers, estimator=estimator)
+    return frames, homographies
 
-    frames = validate_motion_direction(frames)
 
+def sweep_end_points(start_frame, end_frame, start_column, end_column, fix_param=None):
+    """
+    :return: a list of the (start_frame, end_frame, start_column, end_column) of the panoramas produced by
+    produce_panorama_sequence with the given parameters
+    """
     if fix_param == 'frames':
         min_col = min(start_column, end_column)
         max_col = max(start_column, end_column)
-        for j in range(min_col, max_col // 2):
-            panorama_im = create_panorama(start_frame, end_frame, j, end_column - j, frames, homographies)
-            plt.imsave(f'../Results/{sequence}/panorama_frames{start_frame}-{end_frame}_cols{j}-{end_column - j}.jpg',
-                       BGR2RGB(panorama_im))
+        return [(start_frame, end_frame, j, end_column - j) for j in range(min_col, max_col // 2)]
 
-    elif fix_param == 'cols':
+    if fix_param == 'cols':
         num_frames = end_frame - start_frame + 1
-        for j in range(num_frames // 2):
-            panorama_im = create_panorama(start_frame + j, end_frame - j, start_column, end_column, frames, homographies)
-            plt.imsave(f'../Results/{sequence}/panorama_frames{start_frame+j}-{end_frame-j}_cols{start_column}-{end_column}.jpg',
-                       BGR2RGB(panorama_im))
+        return [(start_frame + j, end_frame - j, start_column, end_column) for j in range(num_frames // 2)]
 
-    else:
-        panorama_im = create_panorama(start_frame, end_frame, start_column, end_column, frames, homographies)
-        plt.imsave(f'../Results/{sequence}/panorama_frames{start_frame}-{end_frame}_cols{start_column}-{end_column}.jpg',
-                   BGR2RGB(panorama_im))
+    return [(start_frame, end_frame, start_column, end_column)]
 
 
-def validate_motion_direction(frames):
+@traced('render_panoramas')
+def render_panoramas(frames, homographies, end_points, sequence, video_path=None, results_dir='../Results',
+                     num_workers=NUM_WORKERS):
+    """
+    Renders the panoramas of the given end points and saves them, either as separate images (see panorama_file_writer)
+    or as the frames of a video.
+    :param end_points: a list of (start_frame, end_frame, start_column, end_column) of every panorama
+    :param sequence: the name of the sequence
+    :param video_path: if given, the panoramas are encoded into a video with this path
+    :param results_dir: the directory in which the folder of the separate images is created
+    :param num_workers: the number of threads used for rendering the panoramas
+    :return: the list of the end points which don't define a legal panorama and were skipped
+    """
+    renderer = PanoramaRenderer(frames, homographies)
+    if video_path is None:
+        return renderer.render_all(end_points, panorama_file_writer(sequence, results_dir), num_workers=num_workers)
+    with VideoSink(video_path) as sink:
+        return renderer.render_all(end_points, sink.write, num_workers=num_workers)
+
+
+def panorama_file_writer(sequence, results_dir='../Results'):
+    """
+    :param sequence: the name of the sequence
+    :param results_dir: the directory in which the folder of the sequence is created
+    :return: a function which saves a panorama of the sequence (see PanoramaRenderer.render_all) in
+    '<results_dir>/<sequence>/panorama_frames<start_frame>-<end_frame>_cols<start_column>-<end_column>.jpg'
+    """
+    os.makedirs(os.path.join(results_dir, sequence), exist_ok=True)
+
+    def write(panorama_im, end_points):
+        start_frame, end_frame, start_column, end_column = end_points
+        with span('save_panorama'):
+            plt.imsave(os.path.join(results_dir, sequence, f'panorama_frames{start_frame}-{end_frame}_cols'
+                                                           f'{start_column}-{end_column}.jpg'), BGR2RGB(panorama_im))
+    return write
+
+
+def validate_motion_direction(frames, keys):
     """
     Validates that the given sequence is taken from left to right. If the sequence was taken from right to left,
     this function reverses the frames.
+    :param frames: the frames of the sequence
+    :param keys: the keys of the frames (see frame_keys)
+    :return: the frames and their keys, ordered from left to right
     """
     test_num = max(int(len(frames) // 10), 1)
     test_homographies = np.zeros((3, 3, test_num))
     for i in range(test_num):
         test_homographies[:, :, i] = Homography(frames[i], frames[i + 1], translation_only=True)
     if np.sum(test_homographies[0, 2, :]) < 0:
-        frames = frames[::-1]
-    return frames
+        return frames[::-1], keys[::-1]
+    return frames, keys
 
 
-def create_left_right_panoramas(dir):
+def create_left_right_panoramas(dir, video_path=None, stride=1, results_dir='../Results', motion_dir='../Motion',
+                                frames_dir='../Frames', num_workers=NUM_WORKERS, estimator='orb'):
     """
     Creates all possible panoramas with the same starting and ending columns. This creates a left to right view.
+    :param dir: the directory of the frames, or a video file
+    :param video_path: if given, the panoramas are encoded into a video with this path instead of being saved as
+    separate images.
+    :param stride: if dir is a video, only every stride-th frame of the video is used
+    :param results_dir: the panoramas are saved in '<results_dir>/<sequence>'
+    :param motion_dir: the directory of the motion files
+    :param frames_dir: the directory of the cached frame stacks
+    :param num_workers: the number of threads used for computing the motion and rendering the panoramas
+    :param estimator: the motion estimator (see MOTION_ESTIMATORS)
+    :return: the number of panoramas that were produced
     """
-    sequence = dir.split('/')[-1]
-    os.system(f'mkdir ../Results/{sequence}')
-
-    # load the frames:
-    frames = load_images(dir)
-    file_name = dir.split('/')[-1]
-    num_frames = len(frames)
-
-    # compute all homographies:
-    try:
-        homographies = np.genfromtxt('../Motion/' + file_name + '.csv', delimiter=',').reshape((3, 3, num_frames - 1))
-    except IOError:
-        homographies = compute_homographies(frames, translation_only=True)
-        csv_data = homographies.reshape((9, num_frames - 1))
-        np.savetxt('../Motion/' + sequence + '.csv', csv_data, delimiter=',')
-
-    frames = validate_motion_direction(frames)
-    im_shape = frames[0].shape
-    for i in range(im_shape[1]):
-        panorama_im = create_panorama(0, num_frames-1, i, i, frames, homographies)
-        plt.imsave(f'../Results/{sequence}/panorama_frames{0}-{num_frames-1}_cols{i}-{i}.jpg',
-                   BGR2RGB(panorama_im))
+    frames, homographies = load_panorama_sequence(dir, motion_dir, frames_dir, stride=stride, num_workers=num_workers,
+                                                  estimator=estimator)
+    end_points = [(0, len(frames) - 1, i, i) for i in range(frames[0].shape[1])]
+    skipped = render_panoramas(frames, homographies, end_points, sequence_name(dir), video_path, results_dir,
+                               num_workers)
+    return len(end_points) - len(skipped)
 
 
 # create_left_right_panoramas('../Data/train-in-snow')
@@ -0,0 +1,284 @@
+from Code.GUI_helper import *
+from Code.frame_sources import *
+
+
+# This file contains the panorama engine of the X-Slits task. A slice of the space-time volume is first described by
+# the source frame and the source column of every column of the panorama, and the panorama is then gathered from the
+# frames by a single fancy-indexing operation, instead of copying the strip of every frame separately.
+
+
+class PanoramaSlice:
+    """
+    The description of an X-Slits panorama: column j of the panorama is column column_index[j] of frame
+    frame_index[j]. The same slice can be gathered from frames of different sources.
+    """
+
+    def __init__(self, frame_index, column_index, strips=None):
+        """
+        :param frame_index: an int array with the index of the source frame of every column of the panorama
+        :param column_index: an int array with the source column of every column of the panorama
+        :param strips: the strips the slice was created from, if any (see from_strips)
+        """
+        self.frame_index = frame_index
+        self.column_index = column_index
+        self.strips = strips
+
+    @classmethod
+    def from_strips(cls, strips):
+        """
+        Creates a slice from a list of strips, which are copied one after the other into the panorama.
+        :param strips: a list of (frame, first_column, end_column) of every strip. The strip consists of the columns
+                first_column to end_column-1 of the frame.
+        :return: a PanoramaSlice
+        """
+        strips = np.array(strips, dtype=int).reshape(-1, 3)
+        widths = strips[:, 2] - strips[:, 1]
+        offsets = np.cumsum(widths) - widths
+        frame_index = np.repeat(strips[:, 0], widths)
+        column_index = np.arange(widths.sum()) + np.repeat(strips[:, 1] - offsets, widths)
+        return cls(frame_index, column_index, strips)
+
+    @classmethod
+    def from_end_points(cls, homographies, frame_width, start_frame, end_frame, start_column, end_column):
+        """
+        Computes the slice defined by the given end points.
+        :param homographies: a 3x3xN array of the translations between every two consecutive frames in the sequence
+        :param frame_width: the width of the frames
+        :param start_frame: the first frame to use for the panorama
+        :param end_frame: the last frame to use for the panorama
+        :param start_column: the column of the slit in the first frame
+        :param end_column: the column of the slit in the last frame
+        :return: a PanoramaSlice
+        """
+        motions = np.round(homographies[0, 2, :]).astype(int)
+        return cls.from_strips(slice_strips(motions, frame_width, start_frame, end_frame, start_column, end_column))
+
+    def shifted(self, shift):
+        """
+        :return: the slice which samples the same frames as this slice, shift columns to the right. The frame indices
+                are shared with this slice.
+        """
+        strips = None if self.strips is None else self.strips + np.array([0, shift, shift])
+        return PanoramaSlice(self.frame_index, self.column_index + shift, strips)
+
+    @property
+    def width(self):
+        return len(self.frame_index)
+
+    def used_frames(self):
+        """
+        :return: the indices of the frames used by the panorama
+        """
+        return np.unique(self.frame_index)
+
+    @traced('gather')
+    def gather(self, frames):
+        """
+        Creates the panorama from the given frames.
+        :param frames: the frames of the sequence (a FrameStack, an array with shape (N, H, W, 3), or a list of frames)
+        :return: the panorama image
+        """
+        array = frames.array if isinstance(frames, FrameStack) else frames
+        if isinstance(array, np.ndarray) and array.flags.c_contiguous:
+            # every pixel is viewed as a single element, so a pixel is copied as a whole instead of channel by channel
+            pixels = array.view(np.dtype((np.void, array.shape[3] * array.itemsize)))[..., 0]
+            columns = pixels[self.frame_index, :, self.column_index]
+            return np.ascontiguousarray(columns.T).view(array.dtype).reshape(array.shape[1], self.width, array.shape[3])
+        if isinstance(array, np.ndarray):
+            return array[self.frame_index, :, self.column_index].transpose(1, 0, 2).copy()
+
+        # frames that can't be indexed together are gathered one at a time
+        frame_shape = frames[0].shape
+        panorama_im = np.zeros((frame_shape[0], self.width) + frame_shape[2:], dtype=np.uint8)
+        for i in self.used_frames():
+            columns = self.frame_index == i
+            panorama_im[:, columns] = frames[i][:, self.column_index[columns]]
+        return panorama_im
+
+
+def slice_strips(motions, frame_width, start_frame, end_frame, start_column, end_column):
+    """
+    Computes the strips of the panorama defined by the given end points.
+    :param motions: the rounded x-translations between every two consecutive frames in the sequence
+    :param frame_width: the width of the frames
+    :param start_frame: the first frame to use for the panorama
+    :param end_frame: the last frame to use for the panorama
+    :param start_column: the column of the slit in the first frame
+    :param end_column: the column of the slit in the last frame
+    :return: an int array with the (frame, first_column, end_column) of every strip (see PanoramaSlice.from_strips)
+    """
+    motions = motions[start_frame:end_frame]
+    if start_column <= end_column:
+        strips = small_start_strips(motions, frame_width, start_frame, end_frame, start_column, end_column)
+    else:
+        strips = big_start_strips(motions, frame_width, start_frame, end_frame, start_column, end_column)
+    strips = np.array(strips, dtype=int).reshape(-1, 3)
+    if np.any(strips[:, 1] < 0) or np.any(strips[:, 1] > strips[:, 2]) or np.any(strips[:, 2] > frame_width):
+        raise ValueError('illegal panorama')
+    return strips
+
+
+def small_start_strips(motions, frame_width, start_frame, end_frame, start_column, end_column):
+    """
+    Computes the strips of a panorama in the case where the starting column is smaller than the ending column.
+    :param motions: the rounded x-translations between the consecutive frames start_frame to end_frame
+    :return: a list of (frame, first_column, end_column) of every strip (see PanoramaSlice.from_strips)
+    """
+    if start_frame == end_frame:
+        return [(start_frame, start_column, end_column)]
+    num_frames = end_frame - start_frame + 1
+    first_motion = motions[0]
+    frame_index = np.arange(start_frame, end_frame)
+
+    if start_column == end_column:
+        # take a strip as wide as the motion to the next frame, starting at the slit (or ending at the frame's edge)
+        first_columns = np.where(start_column + motions < frame_width, start_column, frame_width - motions)
+        return np.stack([frame_index, first_columns, first_columns + motions], axis=1)
+
+    if end_column - start_column < first_motion:
+        return [(start_frame, start_column, end_column)] + \
+            list(small_start_strips(motions, frame_width, start_frame, end_frame, start_column, start_column))
+
+    start_pos = calculate_added_motion(start_column + first_motion, end_column, num_frames)
+    strip_motions = np.concatenate([[first_motion], motions])
+    return np.stack([np.arange(start_frame, end_frame + 1), start_pos[:-1] - strip_motions, start_pos[1:]], axis=1)
+
+
+def big_start_strips(motions, frame_width, start_frame, end_frame, start_column, end_column):
+    """
+    Computes the strips of a panorama in the case where the starting column is bigger than the ending column.
+    :param motions: the rounded x-translations between the consecutive frames start_frame to end_frame
+    :return: a list of (frame, first_column, end_column) of every strip (see PanoramaSlice.from_strips)
+    """
+    if start_frame == end_frame:
+        return [(start_frame, end_column, min(start_column + 1, frame_width))]
+    if motions.sum() <= 0:
+        raise ValueError('illegal panorama')
+    num_frames = end_frame - start_frame + 1
+    num_cols = start_column - end_column + 1
+    first_motion = int(motions[0])
+    cur_start = start_column - first_motion
+    strips = []
+    for i in range(num_frames - 2):
+        added_motion = (num_cols - first_motion) // (num_frames - 2)
+        if i < ((num_cols - first_motion) % (num_frames - 2)):
+            added_motion += 1
+        cur_end = cur_start + int(motions[i + 1]) - added_motion
+        if cur_end < cur_start:
+            cur_start, cur_end = cur_end, cur_start
+        slit_width = cur_end - cur_start
+        if cur_end > start_column:
+            cur_end = start_column
+            cur_start = cur_end - slit_width
+        if cur_start < end_column:
+            cur_start = end_column
+            cur_end = cur_start + slit_width
+        strips.append((start_frame + i, cur_start, cur_end))
+        cur_start -= added_motion
+    if sum(strip[2] - strip[1] for strip in strips) > motions.sum():
+        raise ValueError('illegal panorama')
+    return strips
+
+
+def create_panorama(frames, homographies, start_frame, end_frame, start_column, end_column):
+    """
+    Creates a new panorama image defined by the given end points
+    :param frames: the frames of the sequence
+    :param homographies: a 3x3xN array of the translations between every two consecutive frames in the sequence
+    :param start_frame: the first frame to use for the panorama
+    :param end_frame: the last frame to use for the panorama
+    :param start_column: the column of the slit in the first frame
+    :param end_column: the column of the slit in the last frame
+    :return: the new panorama image
+    """
+    panorama_slice = PanoramaSlice.from_end_points(homographies, frames[0].shape[1], start_frame, end_frame,
+                                                   start_column, end_column)
+    return panorama_slice.gather(frames)
+
+
+class PanoramaRenderer:
+    """
+    Renders many panoramas of the same sequence, such as the views of a sweep. The motion of the sequence is prepared
+    once (see MotionTrajectory), and when the strips of a view differ from the strips of the previous view only by a
+    shift of the columns (like consecutive views of a left-right sweep), the view reuses the column maps of the previous
+    view.
+    """
+
+    def __init__(self, frames, homographies):
+        """
+        :param frames: the frames of the sequence
+        :param homographies: a 3x3xN array of the translations between every two consecutive frames in the sequence
+        """
+        self.frames = frames
+        self.frame_width = frames[0].shape[1]
+        self.trajectory = MotionTrajectory(homographies)
+        self.motions = self.trajectory.motions
+        self.last_slice = None
+
+    def panorama_width(self, start_frame, end_frame, start_column, end_column):
+        """
+        Computes the width of the panorama defined by the given end points in constant time, without computing its
+        strips.
+        :return: the width of the panorama. If the starting column is bigger than the ending column, the strips are
+                clipped to the frames and the width is only bounded by the returned value.
+        """
+        if start_column > end_column and start_frame == end_frame:
+            return min(start_column + 1, self.frame_width) - end_column
+        if start_column > end_column:
+            return self.trajectory.x_motion(start_frame, end_frame)
+        return self.trajectory.x_motion(start_frame, end_frame) + end_column - start_column
+
+    def slice(self, start_frame, end_frame, start_column, end_column):
+        """
+        :return: the PanoramaSlice defined by the given end points
+        """
+        # an empty panorama is rejected before its strips are computed
+        if self.panorama_width(start_frame, end_frame, start_column, end_column) <= 0:
+            raise ValueError('illegal panorama')
+        strips = slice_strips(self.motions, self.frame_width, start_frame, end_frame, start_column, end_column)
+        last = self.last_slice
+        if last is not None and last.strips.shape == strips.shape and len(strips):
+            shifts = strips - last.strips
+            if np.all(shifts[:, 0] == 0) and np.all(shifts[:, 1:] == shifts[0, 1]):
+                self.last_slice = last.shifted(int(shifts[0, 1]))
+                return self.last_slice
+        self.last_slice = PanoramaSlice.from_strips(strips)
+        return self.last_slice
+
+    def render(self, end_points):
+        """
+        :param end_points: the (start_frame, end_frame, start_column, end_column) of the panorama
+        :return: the panorama image
+        """
+        return self.slice(*end_points).gather(self.frames)
+
+    def render_all(self, end_points, write, num_workers=1, progress=None):
+        """
+        Renders the panoramas of all the given end points in a single pass. The panoramas are rendered in parallel and
+        passed to write as soon as they are ready, in the order of the end points, so only a few of them are held in
+        memory at once. End points which don't define a legal panorama are skipped, and the other panoramas of the
+        sweep are still rendered.
+        :param end_points: a list of (start_frame, end_frame, start_column, end_column) of every panorama
+        :param write: a function called as write(panorama_im, end_points) for every panorama
+        :param num_workers: the number of threads used for rendering the panoramas
+        :param progress: an optional function called as progress(num_done, num_panoramas) after every panorama
+        :return: the list of the end points which were skipped
+        """
+        end_points = list(end_points)
+        skipped = []
+
+        # the column maps are computed in the calling thread, so the shared maps are built only once
+        def slices():
+            for points in end_points:
+                try:
+                    yield points, self.slice(*points)
+                except ValueError:  # an illegal panorama
+                    skipped.append(points)
+
+        panoramas = parallel_imap(lambda view: (view[0], view[1].gather(self.frames)), slices(),
+                                  num_workers=num_workers)
+        for i, (points, panorama_im) in enumerate(panoramas):
+            write(panorama_im, points)
+            if progress:
+                progress(i + 1 + len(skipped), len(end_points))
+        return skipped